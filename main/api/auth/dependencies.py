@@ -5,8 +5,10 @@ from fastapi.security.oauth2 import OAuth2PasswordBearer
 from jose import jwt
 from jose.exceptions import JWTError
 
+from main.api.auth.cache import user_cache
 from main.api.auth.errors import LoginException, PermException
 from main.api.auth.models import User
+from main.api.auth.permissions import has_permission
 from main.api.auth.schemas import TokenDataSchema, UserSchema
 from main.settings import settings
 from main.logger import logger
@@ -17,6 +19,7 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
+    to_encode["iat"] = datetime.utcnow()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
         to_encode.update({"exp": expire})
@@ -30,7 +33,7 @@ async def requires_login(request: Request, token: str = Depends(oauth2_scheme))
     # logger.debug(await request.form())
     # logger.debug(await request.json())
     # logger.debug(request.headers)
-    logger.debug(f"Validating login with token {token}")
+    logger.debug("Validating login token")
     try:
         payload = jwt.decode(token, settings.secret_key, algorithms=[settings.hash_algorithm])
         username: str = payload.get("username")
@@ -41,11 +44,19 @@ async def requires_login(request: Request, token: str = Depends(oauth2_scheme))
         token_data = TokenDataSchema(username=username, roles=roles, is_admin=is_admin)
     except JWTError:
         raise LoginException
+    request.state.permissions = payload.get("perms", 0)
+    cache_key = (token_data.username, payload.get("iat"))
+    cached_user = user_cache.get(cache_key)
+    if cached_user is not None:
+        logger.debug(f"Validated cached user: {cached_user.username}")
+        return cached_user
     user = await User.get(username=token_data.username)
     if user is None:
         raise LoginException
     logger.debug(f"Validated user: {user.username}")
-    return await UserSchema.from_async_orm(user)
+    validated_user = await UserSchema.from_async_orm(user)
+    user_cache.set(cache_key, validated_user)
+    return validated_user
 
 
 async def requires_permission(request: Request, current_user: UserSchema = Depends(requires_login)) -> UserSchema:
@@ -56,6 +67,9 @@ async def requires_permission(request: Request, current_user: UserSchema = Depen
     if current_user.is_admin:
         logger.debug(f"User {current_user.username} is admin")
         return current_user
+    if has_permission(request.state.permissions, endpoint):
+        logger.debug(f"User {current_user.username} has permission to {endpoint}")
+        return current_user
     raise PermException
 
 
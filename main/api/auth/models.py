@@ -1,19 +1,27 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, List
 from passlib.context import CryptContext
 from tortoise import Tortoise, fields, models
 
 from main.api.auth.errors import LoginException
+from main.settings import settings
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt releases the GIL, so hashing in threads keeps the event loop free and scales with cores
+password_executor = ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix="bcrypt")
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
 
+async def verify_password(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+
+async def get_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
 
 
 class User(models.Model):
@@ -32,15 +40,19 @@ class User(models.Model):
         ordering = ["username"]
 
     @classmethod
-    def create(self, **data: Any) -> models.Model:
-        data["hashed_password"] = get_password_hash(data.get("password"))
-        return super().create(**data)
+    async def create(self, **data: Any) -> models.Model:
+        data["hashed_password"] = await get_password_hash(data.get("password"))
+        return await super().create(**data)
 
-    def authenticate(self, password: str) -> models.Model:
-        if verify_password(password, self.hashed_password):
+    async def authenticate(self, password: str) -> models.Model:
+        if await verify_password(password, self.hashed_password):
             return self
         raise LoginException
 
+    async def get_role_names(self) -> List[str]:
+        await self.fetch_related("roles")
+        return [role.name for role in self.roles.related_objects]
+
     async def get_role_ids(self) -> List[int]:
         await self.fetch_related("roles")
         role_ids = []
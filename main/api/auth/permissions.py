@@ -1,3 +1,5 @@
+from typing import Dict, Iterable
+
 from tortoise.exceptions import IntegrityError
 
 from main.api.auth.models import Role, User
@@ -23,6 +25,37 @@ ENDPOINT_PERMS = {
     ]
 }
 
+# Compiled by compile_permissions: endpoint name -> mask of the roles allowed to call it
+ENDPOINT_MASKS: Dict[str, int] = {}
+
+
+def role_bit(name: str) -> int:
+    return 1 << ALL_ROLES.index(name) if name in ALL_ROLES else 0
+
+
+def role_mask(names: Iterable[str]) -> int:
+    mask = 0
+    for name in names:
+        mask |= role_bit(name)
+    return mask
+
+
+def compile_permissions(endpoint_names: Iterable[str]) -> Dict[str, int]:
+    endpoint_names = set(endpoint_names)
+    ENDPOINT_MASKS.clear()
+    for role, endpoints in ENDPOINT_PERMS.items():
+        for endpoint in endpoints:
+            if endpoint not in endpoint_names:
+                logger.warning(f"Permission for unknown endpoint {endpoint} in role {role}")
+            ENDPOINT_MASKS[endpoint] = ENDPOINT_MASKS.get(endpoint, 0) | role_bit(role)
+    logger.debug(f"Compiled permissions for {len(ENDPOINT_MASKS)} endpoints")
+    return ENDPOINT_MASKS
+
+
+def has_permission(mask: int, endpoint: str) -> bool:
+    return bool(ENDPOINT_MASKS.get(endpoint, 0) & mask)
+
+
 async def generate_roles() -> None:
     for r in ALL_ROLES:
         try:
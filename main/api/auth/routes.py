@@ -5,7 +5,9 @@ from fastapi.security import OAuth2PasswordRequestForm
 from tortoise.contrib.fastapi import HTTPNotFoundError
 from tortoise.exceptions import DoesNotExist
 
+from main.api.auth.cache import user_cache
 from main.api.auth.models import User, Role
+from main.api.auth.permissions import role_mask
 from main.api.auth.schemas import TokenSchema, UserSchema, UserCreateSchema, RoleSchema
 from main.api.auth.errors import UserNotFoundException, LoginException
 from main.api.auth.dependencies import create_access_token, requires_login, requires_permission
@@ -25,12 +27,17 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         user = await User.get(username=form_data.username)
     except DoesNotExist as e:
         raise LoginException
-    user.authenticate(form_data.password)
+    await user.authenticate(form_data.password)
     expires_delta = None
     if not rememberme:
         expires_delta = timedelta(minutes=settings.access_token_expire_minutes)
     access_token = create_access_token(
-        data={"username": user.username, "roles": await user.get_role_ids(), "is_admin": user.is_admin}, expires_delta=expires_delta
+        data={
+            "username": user.username,
+            "roles": await user.get_role_ids(),
+            "perms": role_mask(await user.get_role_names()),
+            "is_admin": user.is_admin
+        }, expires_delta=expires_delta
     )
     return {"access_token": access_token, "token_type": "bearer", "expires_on": expires_delta}
 
@@ -69,6 +76,7 @@ async def update_user(user_id: int, user: UserCreateSchema, current_user: UserSc
     updated_count = await User.filter(id=user_id).update(**data)
     if not updated_count:
         raise UserNotFoundException
+    user_cache.clear()
     return await UserSchema.from_queryset_single(User.get(id=user_id))
 
 
@@ -77,6 +85,7 @@ async def delete_user(user_id: int, current_user: UserSchema = Depends(requires_
     deleted_count = await User.filter(id=user_id).delete()
     if not deleted_count:
         raise UserNotFoundException
+    user_cache.clear()
     return StatusSchema(message=f"Deleted user {user_id}")
 
 
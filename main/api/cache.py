@@ -0,0 +1,300 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Type
+
+from tortoise import models
+
+from main.logger import logger
+from main.settings import settings
+
+
+def row_tag(model: Type[models.Model], obj_id: Any) -> str:
+    return f"{model.__name__}:{obj_id}"
+
+
+def model_tag(model: Type[models.Model]) -> str:
+    """Matches no entry, evicting it only bumps the version of ``model`` (new rows)."""
+    return f"{model.__name__}:*"
+
+
+def _tag_models(tags: Iterable[str]) -> Set[str]:
+    return {tag.partition(":")[0] for tag in tags}
+
+
+def document_tags(model: Type[models.Model], document: Any) -> Set[str]:
+    """Tags of every row serialized in ``document``, following the relations of ``model``."""
+    tags = set()
+    if isinstance(document, list):
+        for item in document:
+            tags |= document_tags(model, item)
+    elif isinstance(document, dict):
+        if document.get("id") is not None:
+            tags.add(row_tag(model, document["id"]))
+        for key, value in document.items():
+            if key in model._meta.fetch_fields and value:
+                tags |= document_tags(model._meta.fields_map[key].related_model, value)
+    return tags
+
+
+def fk_tags(model: Type[models.Model], rows: Iterable[Any]) -> Set[str]:
+    """Tags of the rows that ``rows`` (objects or data dicts) point to through their FKs."""
+    tags = set()
+    for row in rows:
+        for fk_field in model._meta.fk_fields:
+            field = model._meta.fields_map[fk_field]
+            value = row.get(field.source_field) if isinstance(row, dict) else getattr(row, field.source_field, None)
+            if value:
+                tags.add(row_tag(field.related_model, value))
+    return tags
+
+
+async def cascade_rows(model: Type[models.Model], ids: List[int], rows: Optional[Dict[Type[models.Model], Set[int]]] = None) -> Dict[Type[models.Model], Set[int]]:
+    """Ids of ``ids`` and of every row a delete of them cascades to, by model."""
+    rows = {} if rows is None else rows
+    rows.setdefault(model, set()).update(ids)
+    if not ids:
+        return rows
+    for relation in model._meta.backward_fk_fields:
+        field = model._meta.fields_map[relation]
+        child_ids = await field.related_model.filter(**{f"{field.relation_field}__in": ids}).values_list("id", flat=True)
+        await cascade_rows(field.related_model, list(child_ids), rows)
+    return rows
+
+
+def rows_tags(rows: Dict[Type[models.Model], Iterable[int]]) -> Set[str]:
+    return {row_tag(model, obj_id) for model, ids in rows.items() for obj_id in ids}
+
+
+async def cascade_tags(model: Type[models.Model], ids: List[int]) -> Set[str]:
+    """Tags of ``ids`` and of every row a delete of them cascades to."""
+    return rows_tags(await cascade_rows(model, ids))
+
+
+class MemoryStore:
+    """LRU of bodies plus a tag index, local to the process."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.generation = 0
+        self._data: "OrderedDict[str, Tuple[bytes, Set[str]]]" = OrderedDict()
+        self._tags: Dict[str, Set[str]] = {}
+        # Evictions per model name, "*" counts clears
+        self._versions: Dict[str, int] = {}
+        # Versions of different processes are not comparable
+        self.uid = uuid.uuid4().hex
+
+    def current_generation(self) -> int:
+        return self.generation
+
+    def version(self, model_names: Iterable[str]) -> int:
+        return sum(self._versions.get(name, 0) for name in set(model_names) | {"*"})
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def _drop(self, key: str) -> None:
+        _, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def set(self, key: str, body: bytes, tags: Set[str], generation: int) -> None:
+        if generation != self.generation:
+            return
+        if key in self._data:
+            self._drop(key)
+        self._data[key] = (body, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+
+    def evict(self, tags: Set[str]) -> None:
+        self.generation += 1
+        for name in _tag_models(tags):
+            self._versions[name] = self._versions.get(name, 0) + 1
+        for tag in tags:
+            for key in list(self._tags.get(tag, ())):
+                self._drop(key)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._versions["*"] = self._versions.get("*", 0) + 1
+        self._data.clear()
+        self._tags.clear()
+
+
+class SqliteStore:
+    """
+    Same as MemoryStore but in a sqlite file, so every worker pointed at it sees the same
+    entries and invalidations. Entries are dropped oldest stored first once over ``maxsize``.
+
+    Reads go through their own connection in WAL mode, so they never wait for writers. Writes
+    take the database lock (waiting up to 5s for other workers) on a second connection;
+    ObjectCache runs them in ``executor`` so that wait does not block the event loop.
+    """
+
+    def __init__(self, path: str, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, body BLOB NOT NULL, stored REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored);
+            CREATE TABLE IF NOT EXISTS tags (tag TEXT NOT NULL, key TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+            CREATE INDEX IF NOT EXISTS tags_key ON tags (key);
+            CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO generation VALUES (0, 0);
+            CREATE TABLE IF NOT EXISTS versions (model TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS store (id INTEGER PRIMARY KEY CHECK (id = 0), uid TEXT NOT NULL);
+            INSERT OR IGNORE INTO store VALUES (0, lower(hex(randomblob(16))));
+        """)
+        self.uid = self.connection.execute("SELECT uid FROM store").fetchone()[0]
+        self.writer = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="object-cache")
+
+    def current_generation(self) -> int:
+        return self.connection.execute("SELECT value FROM generation").fetchone()[0]
+
+    def version(self, model_names: Iterable[str]) -> int:
+        names = list(set(model_names) | {"*"})
+        query = f"SELECT COALESCE(SUM(value), 0) FROM versions WHERE model IN ({','.join('?' * len(names))})"
+        return self.connection.execute(query, names).fetchone()[0]
+
+    def _bump(self, model_names: Iterable[str]) -> None:
+        self.writer.executemany(
+            "INSERT INTO versions VALUES (?, 1) ON CONFLICT (model) DO UPDATE SET value = value + 1",
+            [(name,) for name in model_names]
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self.connection.execute("SELECT body FROM entries WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _drop(self, keys: List[str]) -> None:
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            self.writer.execute(f"DELETE FROM entries WHERE key IN ({marks})", chunk)
+            self.writer.execute(f"DELETE FROM tags WHERE key IN ({marks})", chunk)
+
+    def set(self, key: str, body: bytes, tags: Set[str], generation: int) -> None:
+        with self.lock, self.writer:
+            self.writer.execute("BEGIN IMMEDIATE")
+            if generation != self.writer.execute("SELECT value FROM generation").fetchone()[0]:
+                return
+            self._drop([key])
+            self.writer.execute("INSERT INTO entries VALUES (?, ?, ?)", (key, body, time.time()))
+            self.writer.executemany("INSERT INTO tags VALUES (?, ?)", [(tag, key) for tag in tags])
+            extra = self.writer.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.maxsize
+            if extra > 0:
+                self._drop([row[0] for row in self.writer.execute("SELECT key FROM entries ORDER BY stored LIMIT ?", (extra,))])
+
+    def evict(self, tags: Set[str]) -> None:
+        tags = list(tags)
+        with self.lock, self.writer:
+            self.writer.execute("BEGIN IMMEDIATE")
+            self.writer.execute("UPDATE generation SET value = value + 1")
+            self._bump(_tag_models(tags))
+            keys = set()
+            for start in range(0, len(tags), 500):
+                chunk = tags[start:start + 500]
+                rows = self.writer.execute(f"SELECT key FROM tags WHERE tag IN ({','.join('?' * len(chunk))})", chunk)
+                keys.update(row[0] for row in rows)
+            self._drop(list(keys))
+
+    def clear(self) -> None:
+        with self.lock, self.writer:
+            self.writer.execute("BEGIN IMMEDIATE")
+            self.writer.execute("UPDATE generation SET value = value + 1")
+            self._bump(["*"])
+            self.writer.execute("DELETE FROM entries")
+            self.writer.execute("DELETE FROM tags")
+
+
+# Tags evicted while an ``invalidating`` block is open, flushed once it closes
+_pending: ContextVar[Optional[Set[str]]] = ContextVar("pending_evictions", default=None)
+
+
+class ObjectCache:
+    """
+    Serialized single object responses keyed by ``(pathname, id)``. Every entry is tagged
+    with the rows it contains, writes evict the entries tagged with the rows they touch.
+    A response is only stored when nothing was evicted since it started reading, so a
+    read racing a write can not put stale data back.
+    """
+
+    def __init__(self, store) -> None:
+        self.store = store
+
+    def generation(self) -> int:
+        return self.store.current_generation()
+
+    def version(self, model_types: Iterable[Type[models.Model]]) -> int:
+        """Grows every time a row of one of ``model_types`` is written."""
+        return self.store.version(model.__name__ for model in model_types)
+
+    def validator(self, model_types: Iterable[Type[models.Model]]) -> str:
+        """``version`` qualified by the store, equal only where the same writes were counted."""
+        return f"{self.store.uid}-{self.version(model_types)}"
+
+    def get(self, pathname: str, obj_id: int) -> Optional[bytes]:
+        return self.store.get(f"{pathname}:{obj_id}")
+
+    async def _write(self, method, *args: Any) -> None:
+        """Run a store write in the store's executor when it has one, inline otherwise."""
+        executor = getattr(self.store, "executor", None)
+        if executor is None:
+            method(*args)
+        else:
+            await asyncio.get_running_loop().run_in_executor(executor, method, *args)
+
+    async def set(self, pathname: str, obj_id: int, body: bytes, tags: Set[str], generation: int) -> None:
+        await self._write(self.store.set, f"{pathname}:{obj_id}", body, tags, generation)
+
+    def evict(self, tags: Iterable[str]) -> None:
+        tags = set(tags)
+        pending = _pending.get()
+        if pending is not None:
+            pending |= tags
+        elif tags:
+            logger.debug("Evicting cached objects tagged {}", tags)
+            self.store.evict(tags)
+
+    @asynccontextmanager
+    async def invalidating(self):
+        """Hold back evictions until the block, and the transaction inside it, is over."""
+        pending: Set[str] = set()
+        token = _pending.set(pending)
+        try:
+            yield
+        finally:
+            _pending.reset(token)
+            if pending:
+                logger.debug("Evicting cached objects tagged {}", pending)
+                await self._write(self.store.evict, pending)
+
+    def clear(self) -> None:
+        self.store.clear()
+
+
+if settings.object_cache_path:
+    object_cache = ObjectCache(SqliteStore(settings.object_cache_path, settings.object_cache_size))
+else:
+    object_cache = ObjectCache(MemoryStore(settings.object_cache_size))
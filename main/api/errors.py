@@ -4,4 +4,38 @@ class ObjectNotFound(HTTPException):
 
     def __init__(self, name: str, filters: dict) -> None:
         detail = f"{name} with {filters} not found"
-        super().__init__(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
\ No newline at end of file
+        super().__init__(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+
+class InvalidCursor(HTTPException):
+
+    def __init__(self, cursor: str) -> None:
+        detail = f"Invalid cursor {cursor}"
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class InvalidProjection(HTTPException):
+
+    def __init__(self, name: str, field: str) -> None:
+        detail = f"{name} has no field {field}"
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class TooManyProjections(HTTPException):
+
+    def __init__(self, name: str) -> None:
+        detail = f"Too many distinct {name} projections, ask for fewer field combinations"
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class InvalidPatch(HTTPException):
+
+    def __init__(self, reason: str) -> None:
+        detail = f"Invalid patch: {reason}"
+        super().__init__(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=detail)
+
+
+class InvalidPatchData(HTTPException):
+
+    def __init__(self, errors: list) -> None:
+        # Same body as a request that fails validation
+        super().__init__(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=errors)
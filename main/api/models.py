@@ -1,14 +1,23 @@
 from enum import Enum, unique
 from copy import copy
-from typing import Any, Dict, List, Type
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Type
 
-from tortoise import Tortoise, fields, models
+from tortoise import Tortoise, fields, models, timezone
+from tortoise.exceptions import DoesNotExist
+from tortoise.transactions import in_transaction
 from tortoise.manager import Manager
 from tortoise.queryset import QuerySet, UpdateQuery
 from tortoise.query_utils import Q
 
+from main.api.cache import cascade_tags, fk_tags, model_tag, object_cache, row_tag
 from main.logger import logger
 
+
+IVA_RATE = 0.16
+# Bound parameters per statement asyncpg accepts
+POSTGRES_MAX_PARAMETERS = 32767
+
+
 class APIQuerySet(QuerySet):
     
     def _clone(self) -> "APIQuerySet[models.Model]":
@@ -60,50 +69,134 @@ class APIQuerySet(QuerySet):
         for bw_fk_field in self.model._meta.backward_fk_fields.intersection(set(kwargs.keys())):
             logger.debug(f"BW relation detected for field: {bw_fk_field}")
             self.bw_relations[bw_fk_field] = kwargs.pop(bw_fk_field)
-        zero_ids = []
-        for field, value in kwargs.items():
-            if field.endswith("_id") and value == 0:
-                zero_ids.append(field)
-        for field in zero_ids:
-            kwargs.pop(field)
-        uq = super().update(**kwargs)
+        uq = super().update(**APIModel.drop_zero_ids(kwargs))
         return uq
 
-    async def update_bw_relations(self: "APIQuerySet", obj_id: int) -> None:
-        if hasattr(self, "bw_relations"):
-            await APIQuerySet.update_bw_relations_recursive(self.bw_relations, self.model, obj_id)
-    
+    async def update_bw_relations(self: "APIQuerySet", obj_id: int, previous_parents: Iterable[Tuple[Type[models.Model], List[int]]] = ()) -> None:
+        """
+        Sync the BW relations given to ``update`` and refresh the stored totals of the row, of
+        the nested rows that were created or changed or had line items synced, and of the
+        rows they count towards. ``previous_parents`` are the ``totals_parents`` of the row
+        before the update, refreshed as well in case it was moved.
+        """
+        from main.api.totals import refresh_rows
+        async with in_transaction():
+            touched: Dict[Type[models.Model], Set[int]] = {self.model: {obj_id}}
+            for parent, parent_ids in previous_parents:
+                touched.setdefault(parent, set()).update(parent_ids)
+            if hasattr(self, "bw_relations"):
+                await APIQuerySet.update_bw_relations_recursive(self.bw_relations, self.model, obj_id, touched)
+            await refresh_rows(touched)
+
+    async def delete(self) -> int:
+        from main.api.totals import deleting
+        async with in_transaction():
+            ids = await self._clone().values_list("id", flat=True)
+            async with deleting(self.model, ids):
+                deleted_count = await super().delete()
+        return deleted_count
+
+    @staticmethod
+    async def update_bw_relations_recursive(bw_relations: dict, model: models.Model, obj_id: int, touched: Optional[Dict[Type[models.Model], Set[int]]] = None):
+        queries = await APIQuerySet.reconcile_bw_relations(model, [(obj_id, bw_relations)], touched)
+        logger.debug(f"Updated BW relations for {model.__name__} {obj_id} with {queries} queries")
+
     @staticmethod
-    async def update_bw_relations_recursive(bw_relations: dict, model: models.Model, obj_id: int):
-        for field, data_list in bw_relations.items():
-            logger.debug(f"Updating BW relations for {model.__name__} {obj_id} with data {data_list}")
-            new_relations = []
+    async def reconcile_bw_relations(model: models.Model, parents: List[Tuple[int, dict]], touched: Optional[Dict[Type[models.Model], Set[int]]] = None) -> int:
+        """
+        Make the BW relations of every ``(parent_id, bw_relations)`` in ``parents`` match the
+        given data: rows with an "id" are updated when something changed, rows without one are
+        created and the remaining current rows are deleted. Each relation and nesting level is
+        one select, one bulk insert, one bulk update and one delete. Returns the queries used.
+        Rows with stored totals that may have changed are added to ``touched``: created and
+        updated ones, the parents whose relations changed and the ones rows moved from or to.
+        """
+        from main.api.totals import STORED_TOTALS
+        touched = {} if touched is None else touched
+
+        def touch(target: Type[models.Model], ids: Iterable[int]) -> None:
+            if target in STORED_TOTALS:
+                touched.setdefault(target, set()).update(obj_id for obj_id in ids if obj_id is not None)
+
+        queries = 0
+        for field in set().union(*(bw_relations.keys() for _, bw_relations in parents)):
             relation_field = model._meta.fields_map[field].relation_field
             related_model = model._meta.fields_map[field].related_model
-            for data in data_list:
-                related_bw_relations = {}
-                for bw_fk_field in related_model._meta.backward_fk_fields.intersection(set(data.keys())):
-                    logger.debug(f"BW relation detected for field: {bw_fk_field}")
-                    related_bw_relations[bw_fk_field] = data.pop(bw_fk_field)
-                if "id" in data:
-                    result = await related_model.get(pk=data["id"])
-                    for key, value in data.items():
-                        if key != "id":
-                            setattr(result, key, value)
-                    await result.save()
+            totals_fks = {}
+            for fk_field in related_model._meta.fk_fields:
+                fk_object = related_model._meta.fields_map[fk_field]
+                if fk_object.related_model in STORED_TOTALS:
+                    totals_fks[fk_object.source_field] = fk_object.related_model
+            parent_ids = [parent_id for parent_id, bw_relations in parents if field in bw_relations]
+            requested_ids = [data["id"] for _, bw_relations in parents for data in bw_relations.get(field) or [] if "id" in data]
+            current = {obj.id: obj for obj in await related_model.filter(Q(**{f"{relation_field}__in": parent_ids}) | Q(id__in=requested_ids))}
+            queries += 1
+            new_objects, new_children = [], []
+            changed_objects, changed_fields, changed_children = [], set(), []
+            kept_ids = set()
+            for parent_id, bw_relations in parents:
+                for data in bw_relations.get(field) or []:
+                    related_bw_relations = related_model.pop_bw_relations(data)
+                    if "id" not in data:
+                        data[relation_field] = parent_id
+                        new_objects.append(related_model(**APIModel.drop_zero_ids(data)))
+                        new_children.append(related_bw_relations)
+                        touch(model, [parent_id])
+                        continue
+                    obj = current.get(data["id"])
+                    if obj is None:
+                        raise DoesNotExist(f"{related_model.__name__} {data['id']} does not exist")
+                    kept_ids.add(obj.id)
+                    changes = {}
+                    for key, value in APIModel.drop_zero_ids(data).items():
+                        value = related_model._meta.fields_map[key].to_python_value(value)
+                        if key != "id" and getattr(obj, key) != value:
+                            changes[key] = value
+                    if changes:
+                        # A moved row changes the totals of both its previous and its new parent
+                        for key in changes.keys() & totals_fks.keys():
+                            touch(totals_fks[key], [getattr(obj, key), changes[key]])
+                        for key, value in changes.items():
+                            setattr(obj, key, value)
+                        changed_objects.append(obj)
+                        changed_fields.update(changes.keys())
+                        touch(related_model, [obj.id])
+                        touch(model, [getattr(obj, relation_field)])
+                    if related_bw_relations:
+                        changed_children.append((obj.id, related_bw_relations))
+            if new_objects:
+                object_cache.evict(fk_tags(related_model, new_objects) | {model_tag(related_model)})
+                queries += 1
+                if any(new_children) or related_model in STORED_TOTALS:
+                    new_ids = await related_model.bulk_create_ids(new_objects)
+                    touch(related_model, new_ids)
                 else:
-                    data[relation_field] = obj_id
-                    # result, _ = await related_model.get_or_create(**data)
-                    result = related_model(**data)
-                    await result.save()
-                new_relations.append(result.id)
-                if (related_bw_relations):
-                    await APIQuerySet.update_bw_relations_recursive(related_bw_relations, related_model, result.id)
-            current_related = await related_model.filter(**{relation_field: obj_id})
-            for current in current_related:
-                if not current.id in new_relations:
-                    await current.delete()
-
+                    await related_model.bulk_create(new_objects)
+                if any(new_children):
+                    _, child_queries = await related_model.bulk_create_bw_relations(list(zip(new_ids, new_children)))
+                    queries += child_queries
+            if changed_objects:
+                object_cache.evict({row_tag(related_model, obj.id) for obj in changed_objects} | fk_tags(related_model, changed_objects))
+                changed_fields.update(name for name, field_object in related_model._meta.fields_map.items() if getattr(field_object, "auto_now", False))
+                for obj in changed_objects:
+                    for key in changed_fields:
+                        field_object = related_model._meta.fields_map[key]
+                        value = timezone.now() if getattr(field_object, "auto_now", False) else getattr(obj, key)
+                        # bulk_update hands the values to pypika as they are
+                        setattr(obj, key, field_object.to_db_value(value, obj))
+                await related_model.bulk_update(changed_objects, fields=changed_fields)
+                queries += 1
+            stale_ids = [obj.id for obj in current.values() if getattr(obj, relation_field) in parent_ids and obj.id not in kept_ids]
+            if stale_ids:
+                logger.debug(f"Deleting stale BW relations {field}: {stale_ids}")
+                touch(model, [getattr(current[obj_id], relation_field) for obj_id in stale_ids])
+                object_cache.evict(await cascade_tags(related_model, stale_ids))
+                # Plain delete, the caller refreshes the totals of the touched rows once
+                await QuerySet.delete(related_model.filter(id__in=stale_ids))
+                queries += 1
+            if changed_children:
+                queries += await APIQuerySet.reconcile_bw_relations(related_model, changed_children, touched)
+        return queries
 
 
 class APIManager(Manager):
@@ -116,27 +209,106 @@ class APIModel(models.Model):
 
     @classmethod
     async def create(cls: Type[models.Model], **kwargs: Any) -> models.Model:
-        logger.debug(f"Creating object with data: {kwargs}")
+        from main.api.totals import refresh_totals
+        logger.debug("Creating {} with data: {}", cls.__name__, kwargs)
+        bw_relations = cls.pop_bw_relations(kwargs)
+        async with in_transaction():
+            instance = await super().create(**cls.drop_zero_ids(kwargs))
+            logger.debug(f"{cls.__name__} ID generated: {instance.id}")
+            object_cache.evict(fk_tags(cls, [instance]) | {model_tag(cls)})
+            rows, queries = await cls.bulk_create_bw_relations([(instance.id, bw_relations)])
+            await refresh_totals(cls, [instance.id])
+        logger.debug(f"Created {cls.__name__} {instance.id}: {rows + 1} rows inserted with {queries + 1} queries")
+        return instance
+
+    @classmethod
+    def pop_bw_relations(cls: Type[models.Model], data: dict) -> dict:
         bw_relations = {}
-        for bw_fk_field in cls._meta.backward_fk_fields.intersection(set(kwargs.keys())):
+        for bw_fk_field in cls._meta.backward_fk_fields.intersection(set(data.keys())):
             logger.debug(f"BW relation detected for field: {bw_fk_field}")
-            bw_relations[bw_fk_field] = kwargs.pop(bw_fk_field)
+            bw_relations[bw_fk_field] = data.pop(bw_fk_field)
+        return bw_relations
+
+    @staticmethod
+    def drop_zero_ids(data: dict) -> dict:
         zero_ids = []
-        for field, value in kwargs.items():
+        for field, value in data.items():
             if field.endswith("_id") and value == 0:
                 zero_ids.append(field)
         for field in zero_ids:
-            kwargs.pop(field)
-        # logger.debug(f"Creating object with data: {kwargs}")
-        instance = await super().create(**kwargs)
-        logger.debug(f"{cls.__name__} ID generated: {instance.id}")
-        for field, data_list in bw_relations.items():
-            for data in data_list:
-                data[cls._meta.fields_map[field].relation_field] = instance.id
-                logger.debug(f"Creating BW relation {field} with data: {data}")
-                obj = await cls._meta.fields_map[field].related_model.create(**data)
-        return instance
-    
+            data.pop(field)
+        return data
+
+    @classmethod
+    async def bulk_create_ids(cls: Type[models.Model], objects: List[models.Model]) -> List[int]:
+        """
+        Bulk insert ``objects`` and return their ids in the same order; bulk_create leaves
+        generated pks unset. Postgres gets them from ``INSERT ... RETURNING``, SQLite re-selects
+        the rows past the largest id from before the insert, which is safe there because
+        writers are serialized. Other databases insert the rows one by one.
+        """
+        generated = [obj for obj in objects if not obj._custom_generated_pk]
+        generated_ids: List[int] = []
+        db = cls._meta.db
+        if generated and db.capabilities.dialect == "postgres":
+            executor = db.executor_class(model=cls, db=db)
+            columns = [cls._meta.fields_db_projection[name] for name in executor.regular_columns]
+            per_statement = max(POSTGRES_MAX_PARAMETERS // len(columns), 1)
+            for start in range(0, len(generated), per_statement):
+                chunk = generated[start:start + per_statement]
+                query = db.query_class.into(cls._meta.basetable).columns(*columns)
+                for number in range(len(chunk)):
+                    query = query.insert(*(executor.parameter(number * len(columns) + i) for i in range(len(columns))))
+                values = [executor.column_map[name](getattr(obj, name), obj) for obj in chunk for name in executor.regular_columns]
+                _, rows = await db.execute_query(str(query.returning(cls._meta.db_pk_column)), values)
+                generated_ids.extend(row[0] for row in rows)
+        elif generated and db.capabilities.dialect == "sqlite":
+            last_id = await cls.all().order_by("-id").first().values_list("id", flat=True) or 0
+            await cls.bulk_create(generated)
+            generated_ids = await cls.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)
+            if len(generated_ids) != len(generated):
+                raise RuntimeError(f"Inserted {len(generated)} {cls.__name__} rows but found {len(generated_ids)}")
+        elif generated:
+            for obj in generated:
+                await obj.save()
+                generated_ids.append(obj.pk)
+        # Explicit ids last, so the SQLite re-select only finds the generated ones
+        explicit = [obj for obj in objects if obj._custom_generated_pk]
+        if explicit:
+            await cls.bulk_create(explicit)
+        next_ids = iter(generated_ids)
+        return [obj.pk if obj._custom_generated_pk else next(next_ids) for obj in objects]
+
+    @classmethod
+    async def bulk_create_bw_relations(cls: Type[models.Model], parents: List[Tuple[int, dict]]) -> Tuple[int, int]:
+        """
+        Create the BW relations of every ``(parent_id, bw_relations)`` in ``parents`` with a
+        single bulk insert per relation and nesting level. Returns the inserted rows and queries.
+        """
+        rows, queries = 0, 0
+        for field in cls._meta.backward_fk_fields:
+            relation_field = cls._meta.fields_map[field].relation_field
+            related_model = cls._meta.fields_map[field].related_model
+            objects = []
+            children = []
+            for parent_id, bw_relations in parents:
+                for data in bw_relations.get(field) or []:
+                    children.append(related_model.pop_bw_relations(data))
+                    data[relation_field] = parent_id
+                    objects.append(related_model(**related_model.drop_zero_ids(data)))
+            if not objects:
+                continue
+            logger.debug(f"Creating {len(objects)} BW relations {field}")
+            object_cache.evict(fk_tags(related_model, objects) | {model_tag(related_model)})
+            rows, queries = rows + len(objects), queries + 1
+            if not any(children):
+                await related_model.bulk_create(objects)
+                continue
+            ids = await related_model.bulk_create_ids(objects)
+            child_rows, child_queries = await related_model.bulk_create_bw_relations(list(zip(ids, children)))
+            rows, queries = rows + child_rows, queries + child_queries
+        return rows, queries
+
     @classmethod
     async def preprocess_create_data(cls: Type[models.Model], **kwargs: Any) -> dict:
         return await cls.preprocess_data(**kwargs)
@@ -231,6 +403,10 @@ class Provider(APIModel):
         manager = APIManager()
         ordering = ["name"]
 
+    def products_amount(self) -> int:
+        # Shadowed by the COUNT annotation when listed in summary mode
+        return len(self.provider_products)
+
 
 class ProviderContact(APIModel):
     id = fields.IntField(pk=True)
@@ -250,6 +426,10 @@ class Customer(APIModel):
         manager = APIManager()
         ordering = ["name"]
 
+    def products_amount(self) -> int:
+        # Shadowed by the COUNT annotation when listed in summary mode
+        return len(self.customer_products)
+
 
 class CustomerContact(APIModel):
     id = fields.IntField(pk=True)
@@ -316,18 +496,29 @@ class Percentage(APIModel):
 
 class WorkBuy(APIModel):
     id = fields.IntField(pk=True)
-    created_at = fields.DatetimeField(auto_now_add=True)
+    created_at = fields.DatetimeField(auto_now_add=True, index=True)
     modified_at = fields.DatetimeField(auto_now=True)
     customer = fields.ForeignKeyField('models.Customer', related_name='workbuys')
     organization = fields.ForeignKeyField('models.Organization', related_name='workbuys')
+    # Maintained by main.api.totals
+    total = fields.FloatField(default=0, index=True)
+    works_total = fields.FloatField(default=0)
+    earnings = fields.FloatField(default=0, index=True)
 
     class Meta:
         manager = APIManager()
 
+    # Shadowed by the SQL annotations of main.api.totals when listed in summary mode
+    def orders_number(self) -> int:
+        return len(self.orders)
+
+    def works_number(self) -> int:
+        return len(self.works)
+
 
 class StorageBuy(APIModel):
     id = fields.IntField(pk=True)
-    created_at = fields.DatetimeField(auto_now_add=True)
+    created_at = fields.DatetimeField(auto_now_add=True, index=True)
     modified_at = fields.DatetimeField(auto_now=True)
     storage = fields.ForeignKeyField('models.Storage', related_name='storagebuys')
     customer = fields.ForeignKeyField('models.Customer', related_name='storagebuys', null=True)
@@ -336,6 +527,13 @@ class StorageBuy(APIModel):
     class Meta:
         manager = APIManager()
 
+    # Shadowed by the SQL annotations of main.api.totals when listed in summary mode
+    def orders_number(self) -> int:
+        return len(self.orders)
+
+    def total(self) -> float:
+        return sum(order.total for order in self.orders)
+
 
 class PaymentMethod(str, Enum):
     cash = 'c'
@@ -386,7 +584,7 @@ class OrderStates(str, Enum):
 
 class Order(APIModel):
     id = fields.IntField(pk=True)
-    created_at = fields.DatetimeField(auto_now_add=True)
+    created_at = fields.DatetimeField(auto_now_add=True, index=True)
     modified_at = fields.DatetimeField(auto_now=True)
     provider = fields.ForeignKeyField('models.Provider', related_name='orders')
     taxpayer = fields.ForeignKeyField('models.TaxPayer', related_name='orders')
@@ -403,6 +601,9 @@ class Order(APIModel):
     invoice_uuid = fields.UUIDField(null=True)
     invoice_date = fields.DateField(null=True)
     due = fields.DateField(null=True)
+    # Maintained by main.api.totals
+    subtotal = fields.FloatField(default=0)
+    total = fields.FloatField(default=0, index=True)
 
     class Meta:
         manager = APIManager()
@@ -419,7 +620,7 @@ class WorkStates(str, Enum):
 
 class Work(APIModel):
     id = fields.IntField(pk=True)
-    created_at = fields.DatetimeField(auto_now_add=True)
+    created_at = fields.DatetimeField(auto_now_add=True, index=True)
     modified_at = fields.DatetimeField(auto_now=True)
     number = fields.CharField(max_length=12)
     taxpayer = fields.ForeignKeyField('models.TaxPayer', related_name='works')
@@ -438,6 +639,9 @@ class Work(APIModel):
     invoice_uuid = fields.UUIDField(null=True)
     invoice_date = fields.DateField(null=True)
     due = fields.DateField(null=True)
+    # Maintained by main.api.totals
+    subtotal = fields.FloatField(default=0)
+    total = fields.FloatField(default=0, index=True)
 
     class Meta:
         manager = APIManager()
@@ -445,7 +649,6 @@ class Work(APIModel):
     async def create_order(self, product_providers={}, unregistered_product_providers={}, customer_product_providers={}):
         from main.api.schemas import WorkProductSchema
         # WorkProductSchema.__config__.orig_model = Work_Product
-        import pdb; pdb.set_trace()
         wp = await WorkProductSchema.from_queryset(self)
         orders = {}
         for wp_id, p_id in product_providers.items():
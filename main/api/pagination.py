@@ -0,0 +1,110 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from typing import Any, AsyncIterator, List, Optional, Sequence, Type
+
+from pydantic.main import ModelMetaclass
+from tortoise import models
+from tortoise.query_utils import Q
+from tortoise.queryset import QuerySet
+
+from main.api.errors import InvalidCursor
+from main.settings import settings
+
+
+def _cursor_value(value: Any) -> Any:
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    raw = json.dumps([_cursor_value(v) for v in values]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(model: Type[models.Model], keys: Sequence[str], cursor: str) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise InvalidCursor(cursor)
+    try:
+        return [model._meta.fields_map[key].to_python_value(value) for key, value in zip(keys, values)]
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def keyset_filter(keys: Sequence[str], values: Sequence[Any], descending: bool = False) -> Q:
+    """Rows strictly after ``values`` in ``keys`` order, as (a > x) OR (a = x AND b > y) ..."""
+    op = "lt" if descending else "gt"
+    condition = None
+    for i, key in enumerate(keys):
+        filters = dict(zip(keys[:i], values[:i]))
+        filters[f"{key}__{op}"] = values[i]
+        condition = Q(**filters) if condition is None else condition | Q(**filters)
+    return condition
+
+
+def _ordered(queryset: QuerySet, keys: Sequence[str], descending: bool) -> QuerySet:
+    direction = "-" if descending else ""
+    return queryset.order_by(*[f"{direction}{key}" for key in keys])
+
+
+def page_queryset(
+    queryset: QuerySet,
+    keys: Sequence[str],
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    descending: bool = False,
+) -> QuerySet:
+    """The rows after the ``after`` cursor in ``keys`` order, the first ``limit`` of them when given."""
+    queryset = _ordered(queryset, keys, descending)
+    if after:
+        values = decode_cursor(queryset.model, keys, after)
+        queryset = queryset.filter(keyset_filter(keys, values, descending))
+    return queryset.limit(limit) if limit else queryset
+
+
+async def paginate(
+    serializer: ModelMetaclass,
+    queryset: QuerySet,
+    keys: Sequence[str],
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    descending: bool = False,
+) -> dict:
+    limit = limit or settings.page_size
+    items = await serializer.from_queryset(page_queryset(queryset, keys, limit + 1, after, descending))
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([getattr(items[-1], key) for key in keys])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+async def iterate_chunks(
+    serializer: ModelMetaclass,
+    queryset: QuerySet,
+    keys: Sequence[str],
+    after: Optional[str] = None,
+    descending: bool = False,
+    chunk_size: Optional[int] = None,
+) -> AsyncIterator[list]:
+    """Walk the whole queryset in keyset order, ``chunk_size`` serialized rows at a time."""
+    chunk_size = chunk_size or settings.stream_chunk_size
+    queryset = _ordered(queryset, keys, descending)
+    values = decode_cursor(queryset.model, keys, after) if after else None
+    while True:
+        chunk_qs = queryset
+        if values is not None:
+            chunk_qs = chunk_qs.filter(keyset_filter(keys, values, descending))
+        items = await serializer.from_queryset(chunk_qs.limit(chunk_size))
+        if items:
+            yield items
+        if len(items) < chunk_size:
+            return
+        values = [getattr(items[-1], key) for key in keys]
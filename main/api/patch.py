@@ -0,0 +1,188 @@
+from copy import deepcopy
+from decimal import InvalidOperation
+from typing import Any, List, Type
+
+from pydantic import ValidationError as SchemaValidationError
+from pydantic.main import ModelMetaclass
+from tortoise import models
+from tortoise.exceptions import ValidationError
+
+from main.api.errors import InvalidPatch, InvalidPatchData
+from main.api.totals import stored_fields
+
+
+JSON_PATCH_MEDIA_TYPE = "application/json-patch+json"
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    """RFC 7396: objects are merged recursively, null removes a member, anything else replaces."""
+    if not isinstance(patch, dict):
+        return deepcopy(patch)
+    result = deepcopy(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def _pointer(path: str) -> List[str]:
+    if path == "":
+        return []
+    if not path.startswith("/"):
+        raise InvalidPatch(f"invalid pointer {path}")
+    return [part.replace("~1", "/").replace("~0", "~") for part in path[1:].split("/")]
+
+
+def _index(container: list, part: str, path: str, append: bool = False) -> int:
+    if append and part == "-":
+        return len(container)
+    if not part.isdigit() or int(part) > len(container) - (0 if append else 1):
+        raise InvalidPatch(f"no element at {path}")
+    return int(part)
+
+
+def _resolve(document: Any, parts: List[str], path: str) -> Any:
+    for part in parts:
+        if isinstance(document, list):
+            document = document[_index(document, part, path)]
+        elif isinstance(document, dict) and part in document:
+            document = document[part]
+        else:
+            raise InvalidPatch(f"no element at {path}")
+    return document
+
+
+def _add(document: Any, path: str, value: Any) -> Any:
+    parts = _pointer(path)
+    if not parts:
+        return value
+    parent = _resolve(document, parts[:-1], path)
+    if isinstance(parent, list):
+        parent.insert(_index(parent, parts[-1], path, append=True), value)
+    elif isinstance(parent, dict):
+        parent[parts[-1]] = value
+    else:
+        raise InvalidPatch(f"no element at {path}")
+    return document
+
+
+def _remove(document: Any, path: str) -> Any:
+    parts = _pointer(path)
+    if not parts:
+        raise InvalidPatch("the whole document can not be removed")
+    parent = _resolve(document, parts[:-1], path)
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, parts[-1], path))
+    if isinstance(parent, dict) and parts[-1] in parent:
+        return parent.pop(parts[-1])
+    raise InvalidPatch(f"no element at {path}")
+
+
+def json_patch(document: Any, operations: Any) -> Any:
+    """RFC 6902, applied to a copy of ``document``."""
+    if not isinstance(operations, list):
+        raise InvalidPatch("a JSON Patch must be a list of operations")
+    document = deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or "path" not in operation:
+            raise InvalidPatch(f"invalid operation {operation}")
+        op, path = operation.get("op"), operation["path"]
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise InvalidPatch(f"{op} at {path} has no value")
+        if op in ("move", "copy") and "from" not in operation:
+            raise InvalidPatch(f"{op} at {path} has no from")
+        if op == "add":
+            document = _add(document, path, deepcopy(operation["value"]))
+        elif op == "remove":
+            _remove(document, path)
+        elif op == "replace":
+            _remove(document, path)
+            document = _add(document, path, deepcopy(operation["value"]))
+        elif op == "move":
+            document = _add(document, path, _remove(document, operation["from"]))
+        elif op == "copy":
+            document = _add(document, path, deepcopy(_resolve(document, _pointer(operation["from"]), operation["from"])))
+        elif op == "test":
+            if _resolve(document, _pointer(path), path) != operation["value"]:
+                raise InvalidPatch(f"test failed at {path}")
+        else:
+            raise InvalidPatch(f"unknown operation {op}")
+    return document
+
+
+def _python_value(model: Type[models.Model], name: str, value: Any) -> Any:
+    try:
+        return model._meta.fields_map[name].to_python_value(value)
+    except (TypeError, ValueError, InvalidOperation, ValidationError):
+        raise InvalidPatch(f"invalid value for {model.__name__}.{name}: {value}")
+
+
+def write_data(model: Type[models.Model], current: dict, target: dict) -> dict:
+    """
+    Turn the changes between two serialized documents of ``model`` into create/update
+    data: plain fields as they are in the document, FK objects as "<fk>_id" and BW
+    relation lists as lists of child data. Children keep their "id" and only carry their
+    own changes, so unchanged rows are left alone. Read only members (ids, timestamps,
+    stored totals, schema computed values) can not be changed, nor non nullable ones nulled.
+    """
+    meta = model._meta
+    read_only = {meta.pk_attr} | stored_fields(model)
+    data = {}
+    for key in set(current) | set(target):
+        if key in current and key in target and current[key] == target[key]:
+            continue
+        value = target.get(key)
+        field = meta.fields_map.get(key)
+        if key in meta.backward_fk_fields:
+            related_model = field.related_model
+            current_children = {child.get("id"): child for child in current.get(key) or [] if isinstance(child, dict)}
+            data[key] = []
+            for child in value or []:
+                if not isinstance(child, dict):
+                    raise InvalidPatch(f"invalid element in {model.__name__}.{key}")
+                if child.get("id") in current_children:
+                    data[key].append({"id": child["id"], **write_data(related_model, current_children[child["id"]], child)})
+                else:
+                    data[key].append(write_data(related_model, {}, {k: v for k, v in child.items() if k != "id"}))
+        elif key in meta.fk_fields:
+            current_id = (current.get(key) or {}).get("id")
+            target_id = value.get("id") if isinstance(value, dict) else value
+            if target_id == current_id:
+                raise InvalidPatch(f"{model.__name__}.{key} can only be changed through its id")
+            if target_id is None and not field.null:
+                raise InvalidPatch(f"{model.__name__}.{key} can not be null")
+            data[field.source_field] = target_id
+        elif field is None or key in read_only or key in meta.fetch_fields or getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False):
+            raise InvalidPatch(f"{model.__name__}.{key} can not be changed")
+        elif value is None and not field.null:
+            raise InvalidPatch(f"{model.__name__}.{key} can not be null")
+        else:
+            data[key] = value
+    return data
+
+
+def check_data(schema: ModelMetaclass, data: dict) -> None:
+    """
+    Validate ``write_data`` output with ``schema``, the update schema a PUT of the same
+    changes is parsed with. Members left out are kept as they are, so they are not missing.
+    """
+    try:
+        schema.parse_obj(data)
+    except SchemaValidationError as error:
+        errors = [e for e in error.errors() if not (len(e["loc"]) == 1 and e["type"] == "value_error.missing")]
+        if errors:
+            raise InvalidPatchData(errors)
+
+
+def python_data(model: Type[models.Model], data: dict) -> dict:
+    """``write_data`` output with the plain values turned into the python values of their fields."""
+    meta = model._meta
+    result = {}
+    for key, value in data.items():
+        if key in meta.backward_fk_fields:
+            result[key] = [python_data(meta.fields_map[key].related_model, child) for child in value]
+        else:
+            result[key] = _python_value(model, key, value)
+    return result
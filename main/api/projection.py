@@ -0,0 +1,86 @@
+from typing import Dict, List, Optional, Sequence, Tuple, Type
+
+from pydantic.main import ModelMetaclass
+from tortoise import models
+from tortoise.contrib.pydantic import pydantic_model_creator
+from tortoise.contrib.pydantic.base import _get_fetch_fields
+from tortoise.fields.relational import ForeignKeyFieldInstance
+
+from main.api.errors import InvalidProjection, TooManyProjections
+from main.settings import settings
+
+
+def parse_names(value: Optional[str]) -> Tuple[str, ...]:
+    if not value:
+        return ()
+    return tuple(name.strip() for name in value.split(",") if name.strip())
+
+
+def _data_fields(model: Type[models.Model]) -> List[str]:
+    raw_fields = {model._meta.fields_map[name].source_field for name in model._meta.fk_fields}
+    return [name for name in model._meta.fields_map if name not in model._meta.fetch_fields and name not in raw_fields]
+
+
+def _relation_tree(serializer: ModelMetaclass, include: Sequence[str]) -> Dict[str, dict]:
+    model = serializer.__config__.orig_model
+    allowed = [path.split("__") for path in _get_fetch_fields(serializer, model)]
+    tree: Dict[str, dict] = {}
+    for path in include:
+        parts = path.split(".")
+        if not any(allowed_path[:len(parts)] == parts for allowed_path in allowed):
+            raise InvalidProjection(model.__name__, path)
+        node = tree
+        for part in parts:
+            node = node.setdefault(part, {})
+    return tree
+
+
+def _include_paths(model: Type[models.Model], names: Sequence[str], tree: Dict[str, dict], prefix: str = "") -> List[str]:
+    paths = [prefix + name for name in names]
+    for relation, subtree in tree.items():
+        field = model._meta.fields_map[relation]
+        related_model = field.related_model
+        paths.append(prefix + relation)
+        if isinstance(field, ForeignKeyFieldInstance):
+            # pydantic_model_creator drops the raw "<fk>_id" field itself
+            paths.append(prefix + field.source_field)
+        paths += _include_paths(related_model, _data_fields(related_model), subtree, f"{prefix}{relation}.")
+    return paths
+
+
+# Never dropped, Tortoise keeps every model it creates in its own index anyway
+_projections: Dict[Tuple[ModelMetaclass, Tuple[str, ...], Tuple[str, ...]], Tuple[ModelMetaclass, Tuple[str, ...]]] = {}
+
+
+def project(serializer: ModelMetaclass, names: Tuple[str, ...], include: Tuple[str, ...]) -> Tuple[ModelMetaclass, Tuple[str, ...]]:
+    """
+    Build a narrowed serializer for ``names`` (top level data fields) plus the
+    ``include`` relation paths, and the columns to pass to ``QuerySet.only``.
+    Relations not listed in ``include`` are neither serialized nor prefetched.
+    Order and repeats of the names do not count, at most ``settings.max_projections``
+    distinct projections are built.
+    """
+    model = serializer.__config__.orig_model
+    # "id" is always there
+    names, include = tuple(sorted(set(names) | {"id"})) if names else (), tuple(sorted(set(include)))
+    key = (serializer, names, include)
+    if key in _projections:
+        return _projections[key]
+    available = [name for name in _data_fields(model) if name in serializer.__fields__]
+    for name in names:
+        if name not in available:
+            raise InvalidProjection(model.__name__, name)
+    tree = _relation_tree(serializer, include)
+    if len(_projections) >= settings.max_projections:
+        raise TooManyProjections(model.__name__)
+    names = tuple(dict.fromkeys(("id",) + (names or tuple(available))))
+    select = list(names)
+    for relation in tree:
+        field = model._meta.fields_map[relation]
+        if isinstance(field, ForeignKeyFieldInstance):
+            select.append(field.source_field)
+    # Unnamed models without relations are all deduplicated as "<model>.leaf"
+    name = f"{model.__name__}Projection;{','.join(names)};{','.join(include)}"
+    projected = pydantic_model_creator(model, name=name, include=tuple(_include_paths(model, names, tree)))
+    _projections[key] = projected, tuple(select)
+    return _projections[key]
@@ -1,26 +1,44 @@
 import time
 from datetime import date, datetime, timedelta
-from typing import List, Optional
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Type, Union
+import hashlib
 import json
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic.main import BaseModel, ModelMetaclass
+from pypika import Order
 from tortoise import models
 from tortoise.contrib.fastapi import HTTPNotFoundError
 from tortoise.contrib.pydantic import pydantic_model_creator
 from tortoise.contrib.pydantic.base import _get_fetch_fields
-from fastapi_pagination import paginate, Page, Params
+from tortoise.expressions import Subquery
+from tortoise.functions import Count, Max
+from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
 
-from main.api.errors import ObjectNotFound
+from main.api.cache import document_tags, fk_tags, object_cache, row_tag
+from main.api.errors import InvalidPatch, ObjectNotFound
+from main.api.models import APIQuerySet
+from main.api.pagination import iterate_chunks, page_queryset, paginate
+from main.api.patch import JSON_PATCH_MEDIA_TYPE, check_data, json_patch, merge_patch, python_data, write_data
+from main.api.projection import parse_names, project
+from main.api.totals import deleting, stored_fields, totals_parents
 from main.api.auth.schemas import UserSchema
 from main.api.auth.dependencies import requires_login, requires_permission
-from main.api.schemas import ApplianceSerializer, BrandSerializer, CustomerSerializer, EmployeeSerializer, OrderSchema, OrderSerializer, OrganizationSerializer, PercentageSerializer, ProductSerializer, ProviderSerializer, StatusSchema, StorageBuySerializer, StorageSerializer, StorageTypeSerializer, TaxPayerSerializer, WorkBuySerializer, WorkOrderCreateSchema, WorkOrderSchema, WorkSerializer
+from main.api.schemas import ApplianceSerializer, BrandSerializer, CursorPageSchema, CustomerSerializer, EmployeeSerializer, OrderSchema, OrderSerializer, OrganizationSerializer, PercentageSerializer, ProductSerializer, ProviderSerializer, StatusSchema, StorageBuySerializer, StorageSerializer, StorageTypeSerializer, TaxPayerSerializer, WorkBuySerializer, WorkOrderCreateSchema, WorkOrderSchema, WorkSerializer
 from main.logger import logger
+from main.settings import settings
 
 
 router = APIRouter()
 
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
 crud_endpoints = [
     {
         "pathname": 'provider',
@@ -89,10 +107,79 @@ def rename(newname):
 def register_list(router: APIRouter, pathname: str, serializer: ModelMetaclass, **kwargs):
     model = serializer.__config__.orig_model
     base_schema = getattr(serializer.Config, "schema", serializer)
+    response_model = Union[List[base_schema], CursorPageSchema[base_schema]]
+
+    def render(list_schema: Optional[ModelMetaclass], items: list) -> list:
+        if list_schema is None:
+            return items
+        return [list_schema.parse_obj(item.dict()) for item in items]
+
+    async def stream_queryset(list_serializer: ModelMetaclass, list_schema: Optional[ModelMetaclass], qs: QuerySet, keys: Tuple[str, ...], after: Optional[str], descending: bool):
+        amount = 0
+        async for items in iterate_chunks(list_serializer, qs, keys, after, descending):
+            yield "".join(item.json() + "\n" for item in render(list_schema, items))
+            amount += len(items)
+        logger.debug(f"amount: {amount}")
+
+    async def list_queryset(request: Request, qs: QuerySet, keys: Tuple[str, ...], limit: Optional[int], after: Optional[str], descending: bool = False, fields: Optional[str] = None, include: Optional[str] = None, summary: bool = False, selection: str = ""):
+        streaming = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+        # Versions just the rows the response covers, so a page costs what the page does
+        if streaming:
+            covered = page_queryset(qs, keys, None, after, descending)
+        elif limit is not None or after is not None:
+            # One more row, the one that decides next_cursor
+            covered = page_queryset(qs, keys, (limit or settings.page_size) + 1, after, descending)
+        else:
+            covered = qs
+        # ``selection`` covers what the query string leaves implicit, like the default date range
+        etag = await version_etag(serializer, covered, pathname, request.url.query, streaming, selection)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        list_serializer, list_schema = serializer, base_schema
+        if fields or include:
+            list_serializer, select = project(serializer, parse_names(fields) + keys if fields else (), parse_names(include))
+            list_schema = None
+            qs = qs.only(*select)
+        elif summary and hasattr(serializer.Config, "summary_serializer"):
+            list_serializer = serializer.Config.summary_serializer
+            list_schema = getattr(list_serializer.Config, "schema", list_serializer)
+            annotations = getattr(list_serializer.Config, "annotations", {})
+            if annotations:
+                # Tortoise drops Meta.ordering on annotated queries
+                ordering = [("-" if order == Order.desc else "") + name for name, order in model._meta.ordering]
+                qs = qs.annotate(**annotations).order_by(*ordering)
+        if streaming:
+            logger.debug(f"Streaming {pathname}")
+            return StreamingResponse(stream_queryset(list_serializer, list_schema, qs, keys, after, descending), media_type=NDJSON_MEDIA_TYPE, headers=conditional_headers(etag))
+        if limit is None and after is None:
+            result = await list_serializer.from_queryset(qs)
+            amount = len(result)
+        else:
+            result = await paginate(list_serializer, qs, keys, limit, after, descending)
+            amount = len(result["items"])
+        logger.debug(f"amount: {amount}")
+        if list_schema is not list_serializer:
+            if isinstance(result, dict):
+                result["items"] = render(list_schema, result["items"])
+            else:
+                result = render(list_schema, result)
+        return JSONResponse(jsonable_encoder(result), headers=conditional_headers(etag))
+
     if kwargs.get("filter_type") == 'datetime_range':
-        @router.get(f"/{pathname}", response_model=List[base_schema])
+        range_field = kwargs.get("on_field", "created_at")
+        @router.get(f"/{pathname}", response_model=response_model)
         @rename(f"list_{pathname}")
-        async def crud_list(from_date: Optional[date] = None, to_date: Optional[date] = None, current_user: UserSchema = Depends(requires_login)):
+        async def crud_list(
+            request: Request,
+            from_date: Optional[date] = None,
+            to_date: Optional[date] = None,
+            limit: Optional[int] = Query(None, ge=1, le=settings.max_page_size),
+            after: Optional[str] = None,
+            fields: Optional[str] = None,
+            include: Optional[str] = None,
+            summary: bool = False,
+            current_user: UserSchema = Depends(requires_login)
+        ):
             logger.debug(f"Listing {pathname}")
             if from_date is None:
                 from_date = datetime.combine(datetime.utcnow().date(), datetime.min.time()) - timedelta(days=7) + timedelta(seconds=time.timezone)
@@ -103,74 +190,145 @@ def register_list(router: APIRouter, pathname: str, serializer: ModelMetaclass,
             else:
                 to_date = datetime.combine(to_date, datetime.min.time()) + timedelta(days=1) + timedelta(seconds=time.timezone)
             logger.debug(f"Filtering from {from_date} to {to_date}")
-            range_filters = {}
-            if not kwargs.get("on_field"):
-                range_filters = {
-                    "created_at__gte": from_date,
-                    "created_at__lte": to_date
-                }
-            else:
-                range_filters[kwargs["on_field"]+"__gte"] = from_date
-                range_filters[kwargs["on_field"]+"__lte"] = to_date
-            start = time.time()
-            result = await serializer.from_queryset(model.filter(**range_filters).order_by('-id'))
-            end = time.time()
-            logger.debug(f"Response time: {end-start}")
-            logger.debug(f"amount: {len(result)}")
-            return result
+            range_filters = {
+                f"{range_field}__gte": from_date,
+                f"{range_field}__lte": to_date
+            }
+            qs = model.filter(**range_filters).order_by('-id')
+            return await list_queryset(request, qs, (range_field, "id"), limit, after, True, fields, include, summary, f"{from_date}/{to_date}")
         return crud_list
     elif kwargs.get("filter_type") == 'buy_ids':
-        @router.get(f"/{pathname}", response_model=List[base_schema])
+        @router.get(f"/{pathname}", response_model=response_model)
         @rename(f"list_{pathname}")
-        async def crud_list(workbuy_ids: Optional[str] = "", storagebuy_ids: Optional[str] = "", current_user: UserSchema = Depends(requires_login)):
+        async def crud_list(
+            request: Request,
+            workbuy_ids: Optional[str] = "",
+            storagebuy_ids: Optional[str] = "",
+            limit: Optional[int] = Query(None, ge=1, le=settings.max_page_size),
+            after: Optional[str] = None,
+            fields: Optional[str] = None,
+            include: Optional[str] = None,
+            summary: bool = False,
+            current_user: UserSchema = Depends(requires_login)
+        ):
             ids_filters = {}
             if workbuy_ids:
                 ids_filters["workbuy_id__in"] = workbuy_ids.split(",")
             if storagebuy_ids:
                 ids_filters["storagebuy_id__in"] = storagebuy_ids.split(",")
-            result = []
-            if ids_filters:
-                logger.debug(f"Listing {pathname}")
-                start = time.time()
-                result = await serializer.from_queryset(model.filter(**ids_filters))
-                end = time.time()
-                logger.debug(f"Response time: {end-start}")
-                logger.debug(f"amount: {len(result)}")
-            return result
+            if not ids_filters:
+                ids_filters["id__in"] = []
+            logger.debug(f"Listing {pathname}")
+            return await list_queryset(request, model.filter(**ids_filters), ("id",), limit, after, False, fields, include, summary)
         return crud_list
-    @router.get(f"/{pathname}", response_model=List[base_schema])
+    @router.get(f"/{pathname}", response_model=response_model)
     @rename(f"list_{pathname}")
-    async def crud_list(filters: Optional[str] = "{}", current_user: UserSchema = Depends(requires_login)):
+    async def crud_list(
+        request: Request,
+        filters: Optional[str] = "{}",
+        limit: Optional[int] = Query(None, ge=1, le=settings.max_page_size),
+        after: Optional[str] = None,
+        fields: Optional[str] = None,
+        include: Optional[str] = None,
+        summary: bool = False,
+        current_user: UserSchema = Depends(requires_login)
+    ):
         logger.debug(f"Listing {pathname}")
-        # # result = await serializer.from_queryset(model.all())
-        # # import pdb; pdb.set_trace()
-        # qs = model.all()
-        # # pymodel = pydantic_model_creator(model)
-        # # result2 = await pymodel.from_queryset(qs)
-        # result = await serializer.from_queryset(qs)
-        # return result
-        # custom_filters = {}
         custom_filters = json.loads(filters)
-        start = time.time()
-        result = await serializer.from_queryset(model.filter(**custom_filters))
-        end = time.time()
-        logger.debug(f"Response time: {end-start}")
-        return result
+        return await list_queryset(request, model.filter(**custom_filters), ("id",), limit, after, False, fields, include, summary)
     return crud_list
 
 
+def wants_minimal(request: Request, return_: Optional[str]) -> bool:
+    if return_ is not None:
+        return return_ in ("minimal", "id")
+    prefer = request.headers.get("prefer", "")
+    return "return=minimal" in prefer.replace(" ", "").split(",")
+
+
+async def minimal_response(serializer: ModelMetaclass, pathname: str, obj_id: int) -> JSONResponse:
+    """
+    Just the id and the stored totals, without the prefetch tree, along with the ETag a GET of
+    the object would send, so clients can revalidate their copy.
+    """
+    model = serializer.__config__.orig_model
+    values = await model.filter(id=obj_id).values("id", *sorted(stored_fields(model)))
+    if not values:
+        raise ObjectNotFound(model.__name__, {"id": obj_id})
+    etag = await version_etag(serializer, model.filter(id=obj_id), pathname, obj_id, None, None)
+    return JSONResponse(jsonable_encoder(values[0]), headers={"Preference-Applied": "return=minimal", "ETag": etag})
+
+
+@lru_cache(maxsize=None)
+def serializer_models(serializer: ModelMetaclass) -> Set[Type[models.Model]]:
+    """Models of every row ``serializer`` outputs, following its prefetch tree."""
+    model = serializer.__config__.orig_model
+    result = {model}
+    for path in _get_fetch_fields(serializer, model):
+        related_model = model
+        for part in path.split("__"):
+            related_model = related_model._meta.fields_map[part].related_model
+            result.add(related_model)
+    return result
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match compares weakly
+    return etag in (tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(","))
+
+
+async def rows_version(qs: QuerySet) -> Tuple[Any, ...]:
+    """
+    COUNT(*), MAX(id) and MAX(modified_at) (when the model has it) of the rows ``qs`` selects,
+    in one aggregate query. Catches the writes the in-process counters miss, like the ones
+    of migrators, manual SQL or other workers.
+    """
+    model = qs.model
+    aggregates = {"rows": Count("id"), "last_id": Max("id")}
+    if "modified_at" in model._meta.fields_map:
+        aggregates["last_modified"] = Max("modified_at")
+    version = await model.filter(id__in=Subquery(qs.values("id"))).annotate(**aggregates).values(*aggregates)
+    return tuple(version[0][name] for name in aggregates)
+
+
+async def version_etag(serializer: ModelMetaclass, qs: QuerySet, *parts: Any) -> str:
+    """
+    Strong ETag from the write counters of every model ``serializer`` outputs, the
+    ``rows_version`` of ``qs`` and ``parts`` (everything else that selects the
+    representation), so it is known before serializing anything.
+    """
+    validator = object_cache.validator(serializer_models(serializer))
+    version = await rows_version(qs)
+    digest = hashlib.sha256("|".join(str(part) for part in (validator,) + version + parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def conditional_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=conditional_headers(etag))
+
+
 def register_create(router: APIRouter, pathname: str, serializer: ModelMetaclass):
     model = serializer.__config__.orig_model
     base_schema = getattr(serializer.Config, "schema", serializer)
     create_schema = getattr(serializer.Config, "create_schema", base_schema)
     @router.post(f"/{pathname}", response_model=base_schema)
     @rename(f"create_{pathname}")
-    async def crud_create(obj: create_schema, u: UserSchema = Depends(requires_permission)):
+    async def crud_create(obj: create_schema, request: Request, return_: Optional[str] = Query(None, alias="return"), u: UserSchema = Depends(requires_permission)):
         data = obj.dict(exclude_unset=True)
         if hasattr(model, "preprocess_create_data"):
             data = await model.preprocess_create_data(**data)
-        logger.debug(f"Creating {pathname} with {data}")
-        db_obj = await model.create(**data)
+        logger.debug("Creating {} with {}", pathname, data)
+        async with object_cache.invalidating():
+            db_obj = await model.create(**data)
+        if wants_minimal(request, return_):
+            return await minimal_response(serializer, pathname, db_obj.id)
         return await serializer.from_tortoise_orm(db_obj)
     return crud_create
 
@@ -180,9 +338,25 @@ def register_get(router: APIRouter, pathname: str, serializer: ModelMetaclass):
     base_schema = getattr(serializer.Config, "schema", serializer)
     @router.get(f"/{pathname}"+"/{obj_id}", response_model=base_schema, responses={404: {"model": HTTPNotFoundError}})
     @rename(f"get_{pathname}")
-    async def crud_get(obj_id: int, u: UserSchema = Depends(requires_login)):
+    async def crud_get(obj_id: int, request: Request, fields: Optional[str] = None, include: Optional[str] = None, u: UserSchema = Depends(requires_login)):
         logger.debug(f"Getting {pathname} {obj_id}")
-        return await serializer.from_queryset_single(model.get(id=obj_id))
+        etag = await version_etag(serializer, model.filter(id=obj_id), pathname, obj_id, fields, include)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        if fields or include:
+            projected, select = project(serializer, parse_names(fields), parse_names(include))
+            result = await projected.from_queryset_single(model.get(id=obj_id).only(*select))
+            return JSONResponse(jsonable_encoder(result), headers=conditional_headers(etag))
+        # Read before the database, a write evicting in between stops the store below
+        generation = object_cache.generation()
+        body = object_cache.get(pathname, obj_id)
+        if body is not None:
+            return Response(body, media_type="application/json", headers={"X-Cache": "hit", **conditional_headers(etag)})
+        db_obj = await serializer.from_queryset_single(model.get(id=obj_id))
+        document = jsonable_encoder(db_obj if base_schema is serializer else base_schema.parse_obj(db_obj.dict()))
+        response = JSONResponse(document, headers={"X-Cache": "miss", **conditional_headers(etag)})
+        await object_cache.set(pathname, obj_id, response.body, document_tags(model, document), generation)
+        return response
     return crud_get
 
 
@@ -192,30 +366,79 @@ def register_update(router: APIRouter, pathname: str, serializer: ModelMetaclass
     update_schema = getattr(serializer.Config, "update_schema", getattr(serializer.Config, "create_schema", base_schema))
     @router.put(f"/{pathname}"+"/{obj_id}", response_model=base_schema, responses={404: {"model": HTTPNotFoundError}})
     @rename(f"update_{pathname}")
-    async def crud_update(obj_id: int, obj: update_schema, u: UserSchema = Depends(requires_permission)):
-        logger.debug(f"Data received: {obj.dict()}")
+    async def crud_update(obj_id: int, obj: update_schema, request: Request, return_: Optional[str] = Query(None, alias="return"), u: UserSchema = Depends(requires_permission)):
+        logger.opt(lazy=True).debug("Data received: {}", lambda: obj.dict())
         data = obj.dict(exclude_unset=True)
         if hasattr(model, "preprocess_update_data"):
             data = await model.preprocess_update_data(**data)
-        logger.debug(f"Updating {pathname} {obj_id} with {data}")
-        qs = model.filter(id=obj_id)
-        updated_count = await qs.update(**data)
-        if hasattr(qs, "update_bw_relations"):
-            await qs.update_bw_relations(obj_id)
+        logger.debug("Updating {} {} with {}", pathname, obj_id, data)
+        async with object_cache.invalidating(), in_transaction():
+            object_cache.evict({row_tag(model, obj_id)} | fk_tags(model, [data]))
+            qs = model.filter(id=obj_id)
+            # Before the update, in case it moves the row to other parents
+            previous_parents = await totals_parents(model, [obj_id])
+            updated_count = await qs.update(**data)
+            if hasattr(qs, "update_bw_relations"):
+                await qs.update_bw_relations(obj_id, previous_parents)
         #TODO: Validate update for only bw_relations
         # if not updated_count:
         #     raise ObjectNotFound(model.__name__, {"id":obj_id})
+        if wants_minimal(request, return_):
+            return await minimal_response(serializer, pathname, obj_id)
         return await serializer.from_queryset_single(model.get(id=obj_id))
     return crud_update
 
 
+def register_patch(router: APIRouter, pathname: str, serializer: ModelMetaclass):
+    model = serializer.__config__.orig_model
+    base_schema = getattr(serializer.Config, "schema", serializer)
+    update_schema = getattr(serializer.Config, "update_schema", getattr(serializer.Config, "create_schema", base_schema))
+    @router.patch(f"/{pathname}"+"/{obj_id}", response_model=base_schema, responses={404: {"model": HTTPNotFoundError}})
+    @rename(f"patch_{pathname}")
+    async def crud_patch(obj_id: int, request: Request, return_: Optional[str] = Query(None, alias="return"), u: UserSchema = Depends(requires_permission)):
+        patch = await request.json()
+        async with object_cache.invalidating(), in_transaction():
+            db_obj = await serializer.from_queryset_single(model.get(id=obj_id))
+            current = jsonable_encoder(db_obj if base_schema is serializer else base_schema.parse_obj(db_obj.dict()))
+            if request.headers.get("content-type", "").startswith(JSON_PATCH_MEDIA_TYPE):
+                target = json_patch(current, patch)
+            else:
+                target = merge_patch(current, patch)
+            if not isinstance(target, dict):
+                raise InvalidPatch("the result is not an object")
+            data = write_data(model, current, target)
+            check_data(update_schema, data)
+            data = python_data(model, data)
+            logger.debug("Patching {} {} with {}", pathname, obj_id, data)
+            object_cache.evict({row_tag(model, obj_id)} | fk_tags(model, [data]))
+            qs = model.filter(id=obj_id)
+            # Before the update, in case it moves the row to other parents
+            previous_parents = await totals_parents(model, [obj_id])
+            update_query = qs.update(**data)
+            if set(data) - model._meta.backward_fk_fields:
+                await update_query
+            if hasattr(qs, "update_bw_relations"):
+                await qs.update_bw_relations(obj_id, previous_parents)
+        if wants_minimal(request, return_):
+            return await minimal_response(serializer, pathname, obj_id)
+        return await serializer.from_queryset_single(model.get(id=obj_id))
+    return crud_patch
+
+
 def register_delete(router: APIRouter, pathname: str, serializer: ModelMetaclass):
     model = serializer.__config__.orig_model
     @rename(f"delete_{pathname}")
     @router.delete(f"/{pathname}"+"/{obj_id}", response_model=StatusSchema, responses={404: {"model": HTTPNotFoundError}})
     async def crud_delete(obj_id: int, u: UserSchema = Depends(requires_permission)):
         logger.debug(f"Deleting {pathname} {obj_id}")
-        deleted_count = await model.filter(id=obj_id).delete()
+        async with object_cache.invalidating(), in_transaction():
+            qs = model.filter(id=obj_id)
+            if isinstance(qs, APIQuerySet):
+                # Evicts and refreshes the stored totals on its own
+                deleted_count = await qs.delete()
+            else:
+                async with deleting(model, [obj_id]):
+                    deleted_count = await qs.delete()
         if not deleted_count:
             raise ObjectNotFound(model.__name__, {"id":obj_id})
         return StatusSchema(message=f"Deleted {pathname} {obj_id}")
@@ -228,6 +451,7 @@ for endpoint in crud_endpoints:
     register_create(router, endpoint["pathname"], endpoint["serializer"])
     register_get(router, endpoint["pathname"], endpoint["serializer"])
     register_update(router, endpoint["pathname"], endpoint["serializer"])
+    register_patch(router, endpoint["pathname"], endpoint["serializer"])
     register_delete(router, endpoint["pathname"], endpoint["serializer"])
 
 
@@ -324,10 +548,56 @@ async def create_work_order(obj_id: int, wo:WorkOrderSchema, u: UserSchema = Dep
     resp = []
     for order in orders.values():
         if order["order_provider_products"] or order["order_unregisteredproducts"]:
-            logger.debug(f"Creating order: {order}")
+            logger.debug("Creating order: {}", order)
             # data = WorkOrderCreateSchema(**order)
-            db_obj = await OrderSerializer.__config__.orig_model.create(**order)
+            async with object_cache.invalidating():
+                db_obj = await OrderSerializer.__config__.orig_model.create(**order)
             resp.append(await OrderSerializer.from_tortoise_orm(db_obj))
         else:
-            logger.debug(f"Not creating empty order: {order}")
-    return resp
\ No newline at end of file
+            logger.debug("Not creating empty order: {}", order)
+    return resp
+
+
+REFERENCE_PATHNAMES = ("brand", "appliance", "taxpayer", "organization", "storagetype", "employee", "percentage", "storage")
+
+
+class ReferenceBundle:
+    """
+    The lists of ``pathnames`` in one body, kept until a write bumps the cache version of
+    any model they contain. Builds read the version first, so a write during a build only
+    makes the next request build again.
+    """
+
+    def __init__(self, pathnames: Sequence[str]) -> None:
+        self.serializers: Dict[str, ModelMetaclass] = {endpoint["pathname"]: endpoint["serializer"] for endpoint in crud_endpoints if endpoint["pathname"] in pathnames}
+        self.models = set().union(*(serializer_models(serializer) for serializer in self.serializers.values()))
+        self.version: Optional[int] = None
+        self.body = b""
+        self.etag = ""
+
+    async def get(self) -> Tuple[bytes, str]:
+        version = object_cache.version(self.models)
+        if version != self.version:
+            logger.debug(f"Building reference bundle version {version}")
+            document = {}
+            for pathname, serializer in self.serializers.items():
+                base_schema = getattr(serializer.Config, "schema", serializer)
+                items = await serializer.from_queryset(serializer.__config__.orig_model.all())
+                if base_schema is not serializer:
+                    items = [base_schema.parse_obj(item.dict()) for item in items]
+                document[pathname] = jsonable_encoder(items)
+            self.body = JSONResponse(document).body
+            self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+            self.version = version
+        return self.body, self.etag
+
+
+reference_bundle = ReferenceBundle(REFERENCE_PATHNAMES)
+
+
+@router.get("/reference")
+async def get_reference(request: Request, u: UserSchema = Depends(requires_login)):
+    body, etag = await reference_bundle.get()
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return Response(body, media_type="application/json", headers=conditional_headers(etag))
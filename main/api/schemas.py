@@ -1,19 +1,29 @@
-from typing import Dict, List, Optional, Union
+from typing import Dict, Generic, List, Optional, TypeVar, Union
 import datetime
 
 from pydantic import BaseModel, validator, root_validator
+from pydantic.generics import GenericModel
 from tortoise.contrib.pydantic import PydanticModel
 from tortoise.contrib.pydantic.base import _get_fetch_fields
 from tortoise.contrib.pydantic import pydantic_model_creator
+from tortoise.functions import Count
 from tortoise.queryset import QuerySet, QuerySetSingle
 
 from main.logger import logger
-from main.api.models import Appliance, Brand, Customer, Employee, Order, Organization, Percentage, Product, Provider, Storage, StorageBuy, StorageType, TaxPayer, Work_Employee, WorkBuy, Work
+from main.api.totals import storagebuy_totals, workbuy_counts
+from main.api.models import IVA_RATE, Appliance, Brand, Customer, Employee, Order, Organization, Percentage, Product, Provider, Storage, StorageBuy, StorageType, TaxPayer, Work_Employee, WorkBuy, Work
+
+
+T = TypeVar("T")
 
 
 class StatusSchema(BaseModel):
     message: str
 
+class CursorPageSchema(GenericModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str]
+
 class GenericIDSchema(PydanticModel):
     id: int
 
@@ -72,6 +82,10 @@ class ProviderSchema(ProviderBaseSchema):
         v['products_amount'] = len(v['provider_products'])
         return v
 
+class ProviderSummarySchema(ProviderBaseSchema):
+    id: int
+    products_amount: int
+
 class ProviderCreateSchema(ProviderBaseSchema):
     provider_products: Optional[List[ProviderProductCreateSchema]]
 
@@ -91,6 +105,14 @@ ProviderSerializer.Config.schema = ProviderSchema
 ProviderSerializer.Config.create_schema = ProviderCreateSchema
 ProviderSerializer.Config.update_schema = ProviderUpdateSchema
 
+ProviderSummarySerializer = pydantic_model_creator(Provider, name="ProviderSummary", exclude=(
+    "orders",
+    "provider_products",
+), computed=("products_amount",))
+ProviderSummarySerializer.Config.schema = ProviderSummarySchema
+ProviderSummarySerializer.Config.annotations = {"products_amount": Count("provider_products")}
+ProviderSerializer.Config.summary_serializer = ProviderSummarySerializer
+
 ### Customer
 
 class CustomerContactBaseSchema(PydanticModel):
@@ -135,6 +157,10 @@ class CustomerSchema(CustomerBaseSchema):
         v['products_amount'] = len(v['customer_products'])
         return v
 
+class CustomerSummarySchema(CustomerBaseSchema):
+    id: int
+    products_amount: int
+
 class CustomerCreateSchema(CustomerBaseSchema):
     customer_products: Optional[List[CustomerProductCreateSchema]]
 
@@ -151,6 +177,13 @@ CustomerSerializer.Config.schema = CustomerSchema
 CustomerSerializer.Config.create_schema = CustomerCreateSchema
 CustomerSerializer.Config.update_schema = CustomerUpdateSchema
 
+CustomerSummarySerializer = pydantic_model_creator(Customer, name="CustomerSummary", exclude=(
+    "customer_products",
+    "storages", "works", "workbuys", "storagebuys"), computed=("products_amount",))
+CustomerSummarySerializer.Config.schema = CustomerSummarySchema
+CustomerSummarySerializer.Config.annotations = {"products_amount": Count("customer_products")}
+CustomerSerializer.Config.summary_serializer = CustomerSummarySerializer
+
 
 ### Brand
 
@@ -399,7 +432,7 @@ class OrderSchema(OrderBaseSchema):
         v['total'] = v['subtotal']
         v['total'] -= float(v['discount'] or 0.0) or 0.0
         if v['include_iva']:
-            v['total'] += v['total']*0.16
+            v['total'] += v['total']*IVA_RATE
         if v.get('workbuy'):
             print(v['workbuy'])
             v['workbuy_number'] = v['workbuy']['organization']['prefix'] + str(v['workbuy']['id'])
@@ -407,6 +440,25 @@ class OrderSchema(OrderBaseSchema):
             v['storagebuy_number'] = v['storagebuy']['organization']['prefix'] + str(v['storagebuy']['id'])
         return v
 
+class OrderSummarySchema(OrderBaseSchema):
+    id: int
+    created_at: datetime.datetime
+    provider: GenericIDNameSchema
+    taxpayer: GenericIDNameSchema
+    claimant: Optional[GenericIDNameSchema]
+    subtotal: float
+    total: float
+    workbuy_number: Optional[str]
+    storagebuy_number: Optional[str]
+
+    @root_validator(pre=True)
+    def root_validator_pre(cls, v):
+        if v.get('workbuy'):
+            v['workbuy_number'] = v['workbuy']['organization']['prefix'] + str(v['workbuy']['id'])
+        if v.get('storagebuy'):
+            v['storagebuy_number'] = v['storagebuy']['organization']['prefix'] + str(v['storagebuy']['id'])
+        return v
+
 class OrderCreateSchema(OrderBaseSchema):
     provider_id: int
     taxpayer_id: int
@@ -447,6 +499,33 @@ OrderSerializer.Config.schema = OrderSchema
 OrderSerializer.Config.create_schema = OrderCreateSchema
 OrderSerializer.Config.update_schema = OrderUpdateBaseSchema
 
+OrderSummarySerializer = pydantic_model_creator(Order, name="OrderSummary", exclude=(
+    "payments",
+    "order_provider_products",
+    "order_unregisteredproducts",
+    "provider.contacts",
+    "provider.provider_products",
+    "provider.orders",
+    "taxpayer.orders",
+    "taxpayer.works",
+    "claimant.orders",
+    "claimant.work_employees",
+    "workbuy.customer",
+    "workbuy.orders",
+    "workbuy.works",
+    "workbuy.organization.storages",
+    "workbuy.organization.storagebuys",
+    "workbuy.organization.workbuys",
+    "storagebuy.storage",
+    "storagebuy.customer",
+    "storagebuy.orders",
+    "storagebuy.organization.storages",
+    "storagebuy.organization.storagebuys",
+    "storagebuy.organization.workbuys",
+))
+OrderSummarySerializer.Config.schema = OrderSummarySchema
+OrderSerializer.Config.summary_serializer = OrderSummarySerializer
+
 
 
 ### WorkSerializer
@@ -523,7 +602,7 @@ class WorkMinimalSchema(PydanticModel):
         v['total'] = v['subtotal']
         v['total'] -= float(v['discount'] or 0.0) or 0.0
         if v['include_iva']:
-            v['total'] += v['total']*0.16
+            v['total'] += v['total']*IVA_RATE
         return v
 
 class WorkBaseSchema(PydanticModel):
@@ -569,7 +648,26 @@ class WorkSchema(WorkBaseSchema):
         v['total'] = v['subtotal']
         v['total'] -= float(v['discount'] or 0.0) or 0.0
         if v['include_iva']:
-            v['total'] += v['total']*0.16
+            v['total'] += v['total']*IVA_RATE
+        v['customer'] = v["workbuy"]["customer"]
+        v["workbuy_id"] = v["workbuy"].get("id")
+        return v
+
+class WorkSummarySchema(WorkBaseSchema):
+    id: int
+    created_at: datetime.datetime
+    number: str
+    taxpayer: GenericIDNameSchema
+    has_invoice: Optional[bool] = False
+    customer: GenericIDNameSchema
+    state: str
+    due: Optional[datetime.date]
+    subtotal: float
+    total: float
+    workbuy_id: Optional[int]
+
+    @root_validator(pre=True)
+    def root_validator_pre(cls, v):
         v['customer'] = v["workbuy"]["customer"]
         v["workbuy_id"] = v["workbuy"].get("id")
         return v
@@ -616,6 +714,25 @@ WorkSerializer.Config.schema = WorkSchema
 WorkSerializer.Config.create_schema = WorkCreateSchema
 WorkSerializer.Config.update_schema = WorkUpdateBaseSchema
 
+WorkSummarySerializer = pydantic_model_creator(Work, name="WorkSummary", exclude=(
+    "payments",
+    "work_products",
+    "work_customer_products",
+    "work_unregisteredproducts",
+    "work_employees",
+    "taxpayer.orders",
+    "taxpayer.works",
+    "workbuy.organization",
+    "workbuy.orders",
+    "workbuy.works",
+    "workbuy.customer.contacts",
+    "workbuy.customer.customer_products",
+    "workbuy.customer.storagebuys",
+    "workbuy.customer.workbuys",
+))
+WorkSummarySerializer.Config.schema = WorkSummarySchema
+WorkSerializer.Config.summary_serializer = WorkSummarySerializer
+
 
 
 ### WorkBuy
@@ -652,6 +769,24 @@ class WorkBuySchema(PydanticModel):
         return v
 
 
+class WorkBuySummarySchema(PydanticModel):
+    id: int
+    number: str
+    created_at: datetime.datetime
+    customer: GenericIDNameSchema
+    organization: OrganizationSchema
+    orders_number: int
+    works_number: int
+    works_total: float
+    total: float
+    earnings: float
+
+    @root_validator(pre=True)
+    def root_validator_pre(cls, v):
+        v['number'] = v["organization"]['prefix'] + str(v["id"])
+        return v
+
+
 class WorkBuyCreateSchema(PydanticModel):
     customer_id: int
     organization_id: int
@@ -697,6 +832,21 @@ WorkBuySerializer.Config.schema = WorkBuySchema
 WorkBuySerializer.Config.create_schema = WorkBuyCreateSchema
 WorkBuySerializer.Config.update_schema = WorkBuyUpdateSchema
 
+WorkBuySummarySerializer = pydantic_model_creator(WorkBuy, name="WorkBuySummary", exclude=(
+    'orders',
+    'works',
+    'customer.contacts',
+    'customer.storagebuys',
+    'customer.workbuys',
+    'customer.customer_products',
+    'organization.storages',
+    'organization.storagebuys',
+    'organization.workbuys',
+), computed=("orders_number", "works_number"))
+WorkBuySummarySerializer.Config.schema = WorkBuySummarySchema
+WorkBuySummarySerializer.Config.annotations = workbuy_counts()
+WorkBuySerializer.Config.summary_serializer = WorkBuySummarySerializer
+
 
 ### StorageBuy
 
@@ -723,6 +873,22 @@ class StorageBuySchema(PydanticModel):
         return v
 
 
+class StorageBuySummarySchema(PydanticModel):
+    id: int
+    number: str
+    created_at: datetime.datetime
+    customer: GenericIDNameSchema
+    storage: StorageSchema
+    organization: OrganizationSchema
+    orders_number: int
+    total: float
+
+    @root_validator(pre=True)
+    def root_validator_pre(cls, v):
+        v['number'] = v["organization"]['prefix'] + str(v["id"])
+        return v
+
+
 class StorageBuyCreateSchema(PydanticModel):
     customer_id: int
     organization_id: int
@@ -756,6 +922,25 @@ StorageBuySerializer.Config.schema = StorageBuySchema
 StorageBuySerializer.Config.create_schema = StorageBuyCreateSchema
 StorageBuySerializer.Config.update_schema = StorageBuyUpdateSchema
 
+StorageBuySummarySerializer = pydantic_model_creator(StorageBuy, name="StorageBuySummary", exclude=(
+    'orders',
+    'customer.contacts',
+    'customer.storagebuys',
+    'customer.workbuys',
+    'customer.customer_products',
+    'organization.storages',
+    'organization.storagebuys',
+    'organization.workbuys',
+    'storage.organization.storages',
+    'storage.organization.storagebuys',
+    'storage.organization.workbuys',
+    'storage.storagetype.storages',
+    'storage.storagebuys',
+), computed=("orders_number", "total"))
+StorageBuySummarySerializer.Config.schema = StorageBuySummarySchema
+StorageBuySummarySerializer.Config.annotations = storagebuy_totals()
+StorageBuySerializer.Config.summary_serializer = StorageBuySummarySerializer
+
 
 class WorkOrderSchema(PydanticModel):
     work_product_providers: Optional[Dict[int, int]] = {}
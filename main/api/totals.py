@@ -0,0 +1,206 @@
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, List, Sequence, Set, Tuple, Type
+
+from tortoise import models
+from tortoise.expressions import RawSQL
+
+from main.api.cache import cascade_rows, object_cache, row_tag, rows_tags
+from main.api.models import IVA_RATE, Order, StorageBuy, Work, WorkBuy
+from main.logger import logger
+
+
+ORDER_LINES = ("order_provider_products", "order_unregisteredproducts")
+WORK_LINES = ("work_products", "work_customer_products", "work_unregisteredproducts")
+
+
+def _table(model: Type[models.Model], alias: str = "") -> str:
+    return f'"{alias or model._meta.db_table}"'
+
+
+def _column(model: Type[models.Model], field: str, alias: str = "") -> str:
+    return f'{_table(model, alias)}."{model._meta.fields_db_projection[field]}"'
+
+
+def subtotal_sql(model: Type[models.Model], lines: Sequence[str], alias: str = "") -> str:
+    """SUM(amount*price) over every line relation of each ``model`` row, NULL prices count as 0."""
+    parts = []
+    for relation in lines:
+        field = model._meta.fields_map[relation]
+        line_model = field.related_model
+        parts.append(
+            f"(SELECT COALESCE(SUM({_column(line_model, 'amount')} * {_column(line_model, 'price')}), 0)"
+            f" FROM {_table(line_model)}"
+            f" WHERE {_column(line_model, field.relation_field)} = {_column(model, 'id', alias)})"
+        )
+    return " + ".join(parts)
+
+
+def total_sql(model: Type[models.Model], lines: Sequence[str], alias: str = "") -> str:
+    """Same rule and operation order as the schemas: (subtotal - discount), plus IVA when include_iva is set."""
+    net = f"(({subtotal_sql(model, lines, alias)}) - COALESCE({_column(model, 'discount', alias)}, 0))"
+    return f"({net} + {net} * (CASE WHEN {_column(model, 'include_iva', alias)} THEN {IVA_RATE} ELSE 0 END))"
+
+
+def _children_sql(parent: Type[models.Model], relation: str, expression: str) -> str:
+    """Correlated subquery over the ``relation`` children of each ``parent`` row, aliased as ``relation``."""
+    field = parent._meta.fields_map[relation]
+    child = field.related_model
+    return (
+        f"(SELECT {expression} FROM {_table(child)} {_table(child, relation)}"
+        f" WHERE {_column(child, field.relation_field, relation)} = {_column(parent, 'id')})"
+    )
+
+
+def _children_sum_sql(parent: Type[models.Model], relation: str, field: str) -> str:
+    child = parent._meta.fields_map[relation].related_model
+    return _children_sql(parent, relation, f"COALESCE(SUM({_column(child, field, relation)}), 0)")
+
+
+def order_totals() -> Dict[str, RawSQL]:
+    return {
+        "subtotal": RawSQL(subtotal_sql(Order, ORDER_LINES)),
+        "total": RawSQL(total_sql(Order, ORDER_LINES)),
+    }
+
+
+def work_totals() -> Dict[str, RawSQL]:
+    return {
+        "subtotal": RawSQL(subtotal_sql(Work, WORK_LINES)),
+        "total": RawSQL(total_sql(Work, WORK_LINES)),
+    }
+
+
+def workbuy_totals() -> Dict[str, RawSQL]:
+    """Built on the stored order/work totals, so those have to be refreshed first."""
+    total = _children_sum_sql(WorkBuy, "orders", "total")
+    works_total = _children_sum_sql(WorkBuy, "works", "total")
+    return {
+        "total": RawSQL(total),
+        "works_total": RawSQL(works_total),
+        "earnings": RawSQL(f"{works_total} - {total}"),
+    }
+
+
+def workbuy_counts() -> Dict[str, RawSQL]:
+    return {
+        "orders_number": RawSQL(_children_sql(WorkBuy, "orders", "COUNT(*)")),
+        "works_number": RawSQL(_children_sql(WorkBuy, "works", "COUNT(*)")),
+    }
+
+
+def storagebuy_totals() -> Dict[str, RawSQL]:
+    return {
+        "orders_number": RawSQL(_children_sql(StorageBuy, "orders", "COUNT(*)")),
+        "total": RawSQL(_children_sum_sql(StorageBuy, "orders", "total")),
+    }
+
+
+# Models with stored totals columns and how to recompute them, children before the rows they count towards
+STORED_TOTALS = {
+    Order: order_totals,
+    Work: work_totals,
+    WorkBuy: workbuy_totals,
+}
+
+
+def stored_fields(model: Type[models.Model]) -> Set[str]:
+    return set(STORED_TOTALS[model]()) if model in STORED_TOTALS else set()
+
+
+async def _store(model: Type[models.Model], ids: Iterable[int]) -> None:
+    ids = list(set(ids))
+    if ids and model in STORED_TOTALS:
+        object_cache.evict(row_tag(model, obj_id) for obj_id in ids)
+        await model.filter(id__in=ids).update(**STORED_TOTALS[model]())
+
+
+async def _refresh_descendants(model: Type[models.Model], ids: List[int]) -> None:
+    for relation in model._meta.backward_fk_fields:
+        field = model._meta.fields_map[relation]
+        if field.related_model in STORED_TOTALS:
+            child_ids = await field.related_model.filter(**{f"{field.relation_field}__in": ids}).values_list("id", flat=True)
+            if child_ids:
+                await _refresh_descendants(field.related_model, child_ids)
+    await _store(model, ids)
+
+
+async def totals_parents(model: Type[models.Model], ids: Iterable[int]) -> List[Tuple[Type[models.Model], List[int]]]:
+    """Rows with stored totals that the ``model`` rows in ``ids`` count towards."""
+    parents = []
+    ids = list(ids)
+    if not ids:
+        return parents
+    for fk_field in model._meta.fk_fields:
+        field = model._meta.fields_map[fk_field]
+        if field.related_model in STORED_TOTALS:
+            parent_ids = await model.filter(id__in=ids).values_list(field.source_field, flat=True)
+            parents.append((field.related_model, [parent_id for parent_id in set(parent_ids) if parent_id is not None]))
+    return parents
+
+
+async def _refresh_ancestors(model: Type[models.Model], ids: List[int]) -> None:
+    for parent, parent_ids in await totals_parents(model, ids):
+        if parent_ids:
+            await _store(parent, parent_ids)
+            await _refresh_ancestors(parent, parent_ids)
+
+
+async def refresh_totals(model: Type[models.Model], ids: Iterable[int], descendants: bool = True) -> None:
+    """Recompute the stored totals of the ``model`` rows in ``ids`` and of every row they count towards.
+
+    Children are refreshed first when ``descendants`` is set, so a freshly created or updated
+    WorkBuy also gets the totals of its nested orders and works stored.
+    """
+    ids = list(ids)
+    if not ids:
+        return
+    if descendants:
+        await _refresh_descendants(model, ids)
+    else:
+        await _store(model, ids)
+    await _refresh_ancestors(model, ids)
+
+
+async def refresh_rows(rows: Dict[Type[models.Model], Iterable[int]]) -> None:
+    """Recompute the stored totals of just ``rows`` (model -> ids) and of every row they count towards.
+
+    Rows of models without stored totals stand for the rows they count towards. Each model is
+    stored once, after all of its children.
+    """
+    pending: Dict[Type[models.Model], Set[int]] = {}
+    for model, ids in rows.items():
+        if model in STORED_TOTALS:
+            pending.setdefault(model, set()).update(ids)
+        else:
+            for parent, parent_ids in await totals_parents(model, ids):
+                pending.setdefault(parent, set()).update(parent_ids)
+    for model in STORED_TOTALS:
+        ids = pending.pop(model, None)
+        if ids:
+            await _store(model, ids)
+            for parent, parent_ids in await totals_parents(model, ids):
+                pending.setdefault(parent, set()).update(parent_ids)
+
+
+@asynccontextmanager
+async def deleting(model: Type[models.Model], ids: Iterable[int]):
+    """
+    Wrap a delete of the ``model`` rows in ``ids``: evicts them and every row the delete
+    cascades to, and once it is done refreshes the stored totals those rows counted towards.
+    The parents are collected first, the cascaded orders, works and line items are gone after.
+    """
+    rows = await cascade_rows(model, list(ids))
+    object_cache.evict(rows_tags(rows))
+    parents: Dict[Type[models.Model], Set[int]] = {}
+    for cascaded, cascaded_ids in rows.items():
+        for parent, parent_ids in await totals_parents(cascaded, cascaded_ids):
+            parents.setdefault(parent, set()).update(parent_ids)
+    yield
+    await refresh_rows(parents)
+
+
+async def backfill_totals() -> None:
+    """Fill every stored totals column from the line items, children before parents."""
+    for model, columns in STORED_TOTALS.items():
+        updated = await model.all().update(**columns())
+        logger.debug(f"Backfilled totals of {updated} {model.__name__} rows")
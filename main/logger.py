@@ -1,23 +1,52 @@
+import sys
 from pathlib import Path
+from typing import Callable, Dict
 
 from loguru import logger
 
+from main.settings import settings
+
 
 def _mk_log_dir(path: str) -> Path:
     return Path(__file__).parent.absolute() / path
 
 
+def _level_filter(levels: Dict[str, str], default: str) -> Callable[[dict], bool]:
+    """Per-module levels: the longest matching module prefix in ``levels`` wins."""
+    prefixes = sorted(levels, key=len, reverse=True)
+    level_nos = {prefix: logger.level(levels[prefix]).no for prefix in prefixes}
+    default_no = logger.level(default).no
+
+    def level_filter(record: dict) -> bool:
+        name = record["name"] or ""
+        for prefix in prefixes:
+            if name == prefix or name.startswith(prefix + "."):
+                return record["level"].no >= level_nos[prefix]
+        return record["level"].no >= default_no
+
+    return level_filter
+
+
 def log_config(
     file_path: Path = _mk_log_dir("logs/modb_be.log"),
-    file_retention=1,
-    file_rotation=30,
-    level="DEBUG",
+    file_retention=settings.log_retention,
+    file_rotation=settings.log_rotation,
+    file_compression=settings.log_compression,
+    level=settings.log_level,
+    levels=settings.log_levels,
+    production=settings.log_mode == "production",
 ):
-    """logger sane defaults."""
+    """logger sane defaults, production mode writes from a background thread."""
+    level_filter = _level_filter(levels, level)
+    # loguru skips formatting below the lowest sink level
+    min_level = min([logger.level(level).no] + [logger.level(module_level).no for module_level in levels.values()])
+    logger.remove()
+    logger.add(sys.stderr, level=min_level, filter=level_filter, enqueue=production)
     logger.add(
-        level=level, sink=file_path,
-        rotation=file_rotation, retention=file_retention
+        level=min_level, sink=file_path, filter=level_filter,
+        rotation=file_rotation, retention=file_retention,
+        compression=file_compression, enqueue=production
     )
 
 
-log_config()
\ No newline at end of file
+log_config()
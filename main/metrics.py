@@ -0,0 +1,216 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, List, Optional, Sequence, Tuple, Type
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from main.logger import logger
+from main.settings import settings
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+QUERY_METHODS = ("execute_insert", "execute_many", "execute_query", "execute_query_dict")
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+
+class Metrics:
+    """
+    Per endpoint request counters, latency and payload size histograms and in flight
+    gauges. Everything runs on the event loop, so no locking is needed.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests: Dict[Tuple[str, str, int], int] = defaultdict(int)
+        self.in_flight: Dict[str, int] = defaultdict(int)
+        self.latency: Dict[str, Histogram] = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.request_size: Dict[str, Histogram] = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.response_size: Dict[str, Histogram] = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.db_queries: Dict[str, Histogram] = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.db_time: Dict[str, Histogram] = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+
+    def observe(self, endpoint: str, method: str, status: int, seconds: float, request_bytes: int, response_bytes: int, stats: "QueryStats") -> None:
+        self.requests[(endpoint, method, status)] += 1
+        self.latency[endpoint].observe(seconds)
+        self.request_size[endpoint].observe(request_bytes)
+        self.response_size[endpoint].observe(response_bytes)
+        self.db_queries[endpoint].observe(stats.queries)
+        self.db_time[endpoint].observe(stats.seconds)
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = [
+            "# HELP http_requests_total Requests handled per endpoint, method and status.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (endpoint, method, status), count in sorted(self.requests.items()):
+            lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+        lines += [
+            "# HELP http_requests_in_flight Requests currently being handled per endpoint.",
+            "# TYPE http_requests_in_flight gauge",
+        ]
+        for endpoint, count in sorted(self.in_flight.items()):
+            lines.append(f'http_requests_in_flight{{endpoint="{endpoint}"}} {count}')
+        for name, help_text, histograms in (
+            ("http_request_duration_seconds", "Request latency per endpoint.", self.latency),
+            ("http_request_size_bytes", "Request body size per endpoint.", self.request_size),
+            ("http_response_size_bytes", "Response body size per endpoint.", self.response_size),
+            ("db_queries_per_request", "SQL queries run by each request per endpoint.", self.db_queries),
+            ("db_time_per_request_seconds", "Time spent in SQL queries by each request per endpoint.", self.db_time),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for endpoint, histogram in sorted(histograms.items()):
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class QueryStats:
+
+    def __init__(self, endpoint: Optional[str] = None) -> None:
+        self.endpoint = endpoint
+        self.queries = 0
+        self.seconds = 0.0
+
+
+query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+# Per task, so concurrent prefetch queries of one request are all counted
+_in_query: ContextVar[bool] = ContextVar("in_query", default=False)
+
+
+def _timed(method):
+    @wraps(method)
+    async def timed(self, query: str, values=None, *args, **kwargs):
+        stats = query_stats.get()
+        if stats is None or _in_query.get():
+            # Outside of a request, or a client method calling another one
+            return await method(self, query, values, *args, **kwargs)
+        running = _in_query.set(True)
+        start = time.perf_counter()
+        try:
+            return await method(self, query, values, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            _in_query.reset(running)
+            stats.queries += 1
+            stats.seconds += seconds
+            if seconds >= settings.slow_query_threshold:
+                logger.warning("Slow query in {} ({:.3f}s): {} {}", stats.endpoint, seconds, query, values)
+    timed.__timed__ = True
+    return timed
+
+
+def _instrument_class(client_class: Type[BaseDBAsyncClient]) -> None:
+    for subclass in [client_class] + client_class.__subclasses__():
+        for name in QUERY_METHODS:
+            method = subclass.__dict__.get(name)
+            if method is not None and not getattr(method, "__timed__", False):
+                setattr(subclass, name, _timed(method))
+
+
+def instrument_connections() -> None:
+    """Count and time the queries of every Tortoise connection (and its transactions)."""
+    for connection in Tortoise._connections.values():
+        _instrument_class(type(connection))
+
+
+def endpoint_name(scope: Scope) -> str:
+    """
+    Name of the endpoint that handles ``scope``, "unmatched" when none does. It is the name
+    permissions use; route names miss renames applied after the route was registered.
+    """
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            endpoint = getattr(route, "endpoint", None)
+            return endpoint.__name__ if endpoint is not None else route.name
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Records every HTTP request under the name of the route that handles it
+    (``list_workbuy``, ``update_work``, ...), unmatched paths are grouped as "unmatched"
+    so arbitrary urls can not grow the label set.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        endpoint = endpoint_name(scope)
+        stats = QueryStats(endpoint)
+        token = query_stats.set(stats)
+        request_bytes = 0
+        response_bytes = 0
+        status = 500
+
+        async def counting_receive() -> Message:
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Message) -> None:
+            nonlocal response_bytes, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                # Streamed responses (bodies without content-length) still query while sending
+                # them, the counts would be partial; the histograms get the full ones
+                if status in (204, 304) or any(name.lower() == b"content-length" for name, _ in headers):
+                    message["headers"] = headers + [
+                        (b"x-db-queries", str(stats.queries).encode()),
+                        (b"x-db-time", f"{stats.seconds:.6f}".encode()),
+                    ]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        metrics.in_flight[endpoint] += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            query_stats.reset(token)
+            metrics.in_flight[endpoint] -= 1
+            metrics.observe(endpoint, scope["method"], status, time.perf_counter() - start, request_bytes, response_bytes, stats)
@@ -0,0 +1,67 @@
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, Sequence, Set, Type
+
+from tortoise import models
+
+from main.api.cache import fk_tags, model_tag, object_cache
+from main.logger import logger
+
+
+# Bound parameters per statement, SQLite's historical default limit
+MAX_PARAMETERS = 999
+
+
+def _records(model: Type[models.Model], fields: Sequence[str], rows: Iterable[Sequence[Any]], converters: List[Any], tags: Set[str]) -> Iterator[tuple]:
+    """``rows`` as DB values, the rows they point to are added to ``tags`` on the way."""
+    for row in rows:
+        tags |= fk_tags(model, [dict(zip(fields, row))])
+        yield tuple(convert(value, model) for convert, value in zip(converters, row))
+
+
+async def bulk_load(model: Type[models.Model], fields: Sequence[str], rows: Iterable[Sequence[Any]]) -> int:
+    """
+    Insert ``rows``, tuples of the values of ``fields``, into the table of ``model``, returns the
+    rows inserted. On Postgres they are streamed through ``COPY ... FROM STDIN``, elsewhere they
+    go as multi-row INSERTs of up to MAX_PARAMETERS values. Rows are not validated nor get their
+    defaults, every non null column must be in ``fields``. Runs in the current transaction.
+    """
+    db = model._meta.db
+    executor = db.executor_class(model=model, db=db)
+    columns = [model._meta.fields_db_projection[field] for field in fields]
+    tags = {model_tag(model)}
+    records = _records(model, fields, rows, [executor.column_map[field] for field in fields], tags)
+    if db.capabilities.dialect == "postgres":
+        async with db.acquire_connection() as connection:
+            status = await connection.copy_records_to_table(model._meta.db_table, records=records, columns=columns)
+        inserted = int(status.split()[-1])
+    else:
+        per_statement = max(MAX_PARAMETERS // len(columns), 1)
+        inserted = 0
+        while True:
+            chunk = list(islice(records, per_statement))
+            if not chunk:
+                break
+            query = db.query_class.into(model._meta.basetable).columns(*columns)
+            for number in range(len(chunk)):
+                query = query.insert(*(executor.parameter(number * len(columns) + i) for i in range(len(columns))))
+            await db.execute_query(str(query), [value for record in chunk for value in record])
+            inserted += len(chunk)
+    object_cache.evict(tags)
+    logger.debug(f"Bulk loaded {inserted} {model.__name__} rows")
+    return inserted
+
+
+async def reset_sequences(*model_types: Type[models.Model]) -> None:
+    """
+    Move the id sequences of ``model_types`` past their largest id, needed on Postgres after
+    inserting explicit ids. SQLite and MySQL already do it on insert.
+    """
+    for model in model_types:
+        db = model._meta.db
+        if db.capabilities.dialect != "postgres" or not model._meta.pk.generated:
+            continue
+        table = model._meta.db_table
+        pk = model._meta.db_pk_column
+        await db.execute_query(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', '{pk}'), COALESCE(MAX(\"{pk}\"), 0) + 1, false) FROM \"{table}\""
+        )
@@ -0,0 +1,72 @@
+import time
+from typing import Iterable, Iterator, Optional, TypeVar
+
+from tortoise import timezone
+
+from main.logger import logger
+from main.migration.models import MigrationCheckpoint
+
+
+T = TypeVar("T")
+
+
+class Checkpoint:
+    """
+    Rows of ``source`` consumed so far. ``track`` counts them as the pipeline pulls them and
+    ``save`` stores the count, in the transaction of the batch that consumed them, so a run
+    started again after a failure skips exactly the rows that were committed.
+    """
+
+    def __init__(self, source: str, total: Optional[int] = None, dry_run: bool = False) -> None:
+        self.source = source
+        self.total = total
+        self.dry_run = dry_run
+        self.position = 0
+        self.written = 0
+        self.started_at = time.monotonic()
+        self.start_position = 0
+
+    async def load(self, restart: bool = False) -> "Checkpoint":
+        if restart:
+            await MigrationCheckpoint.filter(source=self.source).delete()
+        saved = await MigrationCheckpoint.get_or_none(source=self.source)
+        if saved is not None:
+            self.position = self.start_position = saved.position
+            self.written = saved.written
+            logger.info(f"Resuming {self.source} after row {self.position}, {self.written} rows written before")
+        self.started_at = time.monotonic()
+        return self
+
+    def track(self, rows: Iterable[T]) -> Iterator[T]:
+        for row in rows:
+            self.position += 1
+            yield row
+
+    async def save(self, written: int = 0) -> None:
+        self.written += written
+        if self.dry_run:
+            return
+        updated = await MigrationCheckpoint.filter(source=self.source).update(
+            position=self.position, written=self.written, updated_at=timezone.now()
+        )
+        if not updated:
+            await MigrationCheckpoint.create(source=self.source, position=self.position, written=self.written)
+
+    def rate(self) -> float:
+        """Source rows per second consumed by this run."""
+        elapsed = time.monotonic() - self.started_at
+        return (self.position - self.start_position) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> Optional[float]:
+        """Seconds left to read the rest of the source at the current rate."""
+        rate = self.rate()
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.position, 0) / rate
+
+    def report(self) -> None:
+        eta = self.eta()
+        logger.info(
+            f"{self.source}: {self.position}/{self.total or '?'} rows, {self.written} written, "
+            f"{self.rate():.0f} rows/s, ETA {'?' if eta is None else f'{eta:.0f}s'}"
+        )
@@ -0,0 +1,118 @@
+import re
+from decimal import Decimal
+from typing import Any, Collection, Iterator, Optional, Pattern, TextIO, Tuple
+
+
+CHUNK_SIZE = 1 << 16
+# Longest value or statement header kept in memory before giving up on the dump
+MAX_TOKEN = 1 << 26
+
+INSERT = re.compile(r"INSERT\s+(?:IGNORE\s+)?INTO\s+(?:`([^`]+)`|([\w.$]+))\s*(?:\([^)]*\)\s*)?VALUES\s*\(", re.I)
+VALUE = re.compile(
+    r"\s*(?:'((?:[^'\\]|\\.|'')*)'|(NULL)|(-?\d+)(?![\d.eE])|(-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|0x([0-9A-Fa-f]*))\s*([,)])",
+    re.I | re.S
+)
+AFTER_ROW = re.compile(r"\s*([,;])\s*(\()?")
+ESCAPE = re.compile(r"\\(.)|''", re.S)
+ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a", "%": "\\%", "_": "\\_"}
+
+
+def _unescape(match: "re.Match") -> str:
+    if match.group(1) is None:
+        return "'"
+    return ESCAPES.get(match.group(1), match.group(1))
+
+
+class DumpReader:
+    """
+    Rows of the ``INSERT INTO ... VALUES (...),(...);`` statements of a MySQL dump, read
+    ``CHUNK_SIZE`` characters at a time so statements of any length can be parsed. Strings
+    are unescaped, NULL is None, integers are int, other numbers Decimal and hex literals bytes.
+    """
+
+    def __init__(self, file: TextIO, tables: Optional[Collection[str]] = None) -> None:
+        self.file = file
+        self.tables = tables
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """Read the next chunk, dropping what was consumed; False at the end of the file."""
+        if self.eof:
+            return False
+        chunk = self.file.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if len(self.buffer) > MAX_TOKEN + CHUNK_SIZE:
+            raise ValueError(f"Dump token longer than {MAX_TOKEN} characters")
+        return True
+
+    def _match(self, pattern: Pattern) -> Optional["re.Match"]:
+        """``pattern`` at the current position, once it can not grow any further."""
+        while True:
+            match = pattern.match(self.buffer, self.pos)
+            if match and (match.end() < len(self.buffer) or self.eof):
+                return match
+            if not self._fill():
+                return match
+
+    def _statement(self) -> Optional[str]:
+        """Table of the next INSERT, the position left past its first ``(``."""
+        while True:
+            match = INSERT.search(self.buffer, self.pos)
+            if match and match.end() < len(self.buffer):
+                self.pos = match.end()
+                return match.group(1) or match.group(2)
+            # Keep a possible partial header
+            self.pos = max(self.pos, len(self.buffer) - 1024) if not match else match.start()
+            if not self._fill():
+                return None
+
+    def _row(self) -> Tuple[Any, ...]:
+        values = []
+        while True:
+            match = self._match(VALUE)
+            if match is None:
+                raise ValueError(f"Unexpected dump content: {self.buffer[self.pos:self.pos + 80]!r}")
+            self.pos = match.end()
+            string, null, integer, number, binary, separator = match.groups()
+            if string is not None:
+                values.append(ESCAPE.sub(_unescape, string) if "\\" in string or "''" in string else string)
+            elif null is not None:
+                values.append(None)
+            elif integer is not None:
+                values.append(int(integer))
+            elif number is not None:
+                values.append(Decimal(number))
+            else:
+                values.append(bytes.fromhex(binary))
+            if separator == ")":
+                return tuple(values)
+
+    def __iter__(self) -> Iterator[Tuple[str, Tuple[Any, ...]]]:
+        while True:
+            table = self._statement()
+            if table is None:
+                return
+            wanted = self.tables is None or table in self.tables
+            while True:
+                row = self._row()
+                if wanted:
+                    yield table, row
+                match = self._match(AFTER_ROW)
+                if match is None or match.group(1) == ";":
+                    self.pos = match.end() if match else self.pos
+                    break
+                if match.group(2) is None:
+                    raise ValueError(f"Expected a row at: {self.buffer[match.end():match.end() + 80]!r}")
+                self.pos = match.end()
+
+
+def read_dump(path: str, tables: Optional[Collection[str]] = None) -> Iterator[Tuple[str, Tuple[Any, ...]]]:
+    """(table, row) of every INSERTed row of the dump at ``path``, only of ``tables`` when given."""
+    with open(path, "r", encoding="utf-8", newline="") as dump:
+        yield from DumpReader(dump, tables)
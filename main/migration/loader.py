@@ -0,0 +1,181 @@
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Type
+
+from tortoise import models
+from tortoise.transactions import in_transaction
+
+from main.api.cache import fk_tags, model_tag, object_cache
+from main.api.models import (
+    Customer, Customer_Product, Employee, Organization, Product, Provider, Provider_Product, Storage, StorageBuy,
+    StorageType, TaxPayer, WorkBuy
+)
+from main.api.totals import refresh_totals
+from main.logger import logger
+from main.migration.bulk import reset_sequences
+from main.migration.checkpoint import Checkpoint
+
+
+class Lookup:
+    """``key`` -> id of every ``model`` row, loaded with one query; missing rows are created on demand."""
+
+    def __init__(self, model: Type[models.Model], key: str = "name", dry_run: bool = False) -> None:
+        self.model = model
+        self.key = key
+        self.dry_run = dry_run
+        self.ids: Dict[Hashable, int] = {}
+
+    async def load(self) -> "Lookup":
+        self.ids = dict(await self.model.all().values_list(self.key, "id"))
+        return self
+
+    def find(self, value: Hashable) -> Optional[int]:
+        return self.ids.get(value)
+
+    async def get(self, value: Hashable, **defaults: Any) -> Optional[int]:
+        """Id of the row with ``value``, created with ``defaults`` when there is none."""
+        if value in self.ids:
+            return self.ids[value]
+        if self.dry_run:
+            return None
+        obj = await self.model.create(**{self.key: value}, **defaults)
+        self.ids[value] = obj.id
+        return obj.id
+
+
+class MigrationLoader:
+    """
+    Bulk loader for migrated works and orders. Customers, organizations, taxpayers, employees,
+    providers, products, their customer and provider prices, storages and buys are preloaded
+    once and resolved in memory. ``write`` stores a batch of works or orders, along with the
+    buys they created, with one bulk insert per table and nesting level plus one totals
+    refresh, in a transaction.
+    """
+
+    def __init__(self, dry_run: bool = False) -> None:
+        self.dry_run = dry_run
+        self.customers = Lookup(Customer, dry_run=dry_run)
+        self.organizations = Lookup(Organization, dry_run=dry_run)
+        self.prefixes = Lookup(Organization, "prefix", dry_run=dry_run)
+        self.taxpayers = Lookup(TaxPayer, dry_run=dry_run)
+        self.employees = Lookup(Employee, dry_run=dry_run)
+        self.providers = Lookup(Provider, dry_run=dry_run)
+        self.products = Lookup(Product, "code", dry_run=dry_run)
+        self.storagetypes = Lookup(StorageType, dry_run=dry_run)
+        self.customer_products: Dict[Tuple[int, int], int] = {}
+        self.provider_products: Dict[Tuple[int, int], int] = {}
+        self.storages: Dict[Tuple[int, int], int] = {}
+        self.workbuys: Dict[int, Tuple[int, int]] = {}
+        self.storagebuys: Dict[int, Tuple[int, int]] = {}
+        self.next_workbuy_id = 1
+        self.pending: Dict[Type[models.Model], List[models.Model]] = {WorkBuy: [], StorageBuy: []}
+        self.written = 0
+
+    async def load(self) -> "MigrationLoader":
+        lookups = (
+            self.customers, self.organizations, self.prefixes, self.taxpayers, self.employees, self.providers,
+            self.products, self.storagetypes
+        )
+        for lookup in lookups:
+            await lookup.load()
+        for customer_id, product_id, obj_id in await Customer_Product.all().values_list("customer_id", "product_id", "id"):
+            self.customer_products[(customer_id, product_id)] = obj_id
+        for provider_id, product_id, obj_id in await Provider_Product.all().values_list("provider_id", "product_id", "id"):
+            self.provider_products[(provider_id, product_id)] = obj_id
+        for organization_id, storagetype_id, obj_id in await Storage.all().values_list("organization_id", "storagetype_id", "id"):
+            self.storages[(organization_id, storagetype_id)] = obj_id
+        for obj_id, customer_id, organization_id in await WorkBuy.all().values_list("id", "customer_id", "organization_id"):
+            self.workbuys[obj_id] = (customer_id, organization_id)
+        for obj_id, customer_id, organization_id in await StorageBuy.all().values_list("id", "customer_id", "organization_id"):
+            self.storagebuys[obj_id] = (customer_id, organization_id)
+        self.next_workbuy_id = max(self.workbuys, default=0) + 1
+        logger.debug(f"Preloaded {len(self.customers.ids)} customers, {len(self.products.ids)} products, {len(self.workbuys)} workbuys and {len(self.storagebuys)} storagebuys")
+        return self
+
+    async def organization(self, name: str, prefix: Optional[str], by_prefix: bool = False) -> Optional[int]:
+        """Id of the organization called ``name``, or with ``prefix`` first when ``by_prefix``; created when there is none."""
+        org_id = self.organizations.find(name)
+        if by_prefix:
+            org_id = self.prefixes.find(prefix) or org_id
+        if org_id is None:
+            org_id = await self.organizations.get(name, prefix=prefix)
+            if org_id is not None and prefix:
+                self.prefixes.ids[prefix] = org_id
+        return org_id
+
+    async def customer_product(self, customer_id: Optional[int], product_id: int, price: float, code: str) -> Optional[int]:
+        key = (customer_id, product_id)
+        if key not in self.customer_products and not self.dry_run and customer_id:
+            obj = await Customer_Product.create(customer_id=customer_id, product_id=product_id, price=price, code=code)
+            self.customer_products[key] = obj.id
+        return self.customer_products.get(key)
+
+    async def provider_product(self, provider_id: Optional[int], product_id: int, price: float, code: str) -> Optional[int]:
+        key = (provider_id, product_id)
+        if key not in self.provider_products and not self.dry_run and provider_id:
+            obj = await Provider_Product.create(provider_id=provider_id, product_id=product_id, price=price, code=code)
+            self.provider_products[key] = obj.id
+        return self.provider_products.get(key)
+
+    async def storage(self, organization_id: Optional[int], storagetype_id: Optional[int]) -> Optional[int]:
+        key = (organization_id, storagetype_id)
+        if key not in self.storages and not self.dry_run:
+            obj = await Storage.create(organization_id=organization_id, storagetype_id=storagetype_id)
+            self.storages[key] = obj.id
+        return self.storages.get(key)
+
+    async def workbuy(self, workbuy_id: Optional[int], created_at: Any, customer_id: Optional[int], organization_id: Optional[int], update: bool = True) -> Optional[int]:
+        """
+        Id of the workbuy, which is created (on the next write) when missing; a missing or zero
+        id takes the next free one. An existing one is moved to the customer and organization
+        given when ``update`` is set.
+        """
+        if not workbuy_id:
+            workbuy_id = self.next_workbuy_id
+        if workbuy_id in self.workbuys:
+            if update and self.workbuys[workbuy_id] != (customer_id, organization_id) and not self.dry_run:
+                await WorkBuy.filter(id=workbuy_id).update(customer_id=customer_id, organization_id=organization_id)
+                self.workbuys[workbuy_id] = (customer_id, organization_id)
+            return workbuy_id
+        if self.dry_run:
+            return None
+        self.pending[WorkBuy].append(WorkBuy(id=workbuy_id, created_at=created_at, customer_id=customer_id, organization_id=organization_id))
+        self.workbuys[workbuy_id] = (customer_id, organization_id)
+        self.next_workbuy_id = max(self.next_workbuy_id, workbuy_id + 1)
+        return workbuy_id
+
+    async def storagebuy(self, storagebuy_id: int, created_at: Any, customer_id: Optional[int], organization_id: Optional[int], storage_id: Optional[int]) -> Optional[int]:
+        """Id of the storagebuy, which is created (on the next write) when missing."""
+        if storagebuy_id in self.storagebuys:
+            return storagebuy_id
+        if self.dry_run:
+            return None
+        self.pending[StorageBuy].append(StorageBuy(id=storagebuy_id, created_at=created_at, customer_id=customer_id, organization_id=organization_id, storage_id=storage_id))
+        self.storagebuys[storagebuy_id] = (customer_id, organization_id)
+        return storagebuy_id
+
+    async def write(self, model: Type[models.Model], rows: List[dict], checkpoint: Optional[Checkpoint] = None) -> int:
+        """
+        Write the buys created so far and the ``model`` rows (works or orders) with their line
+        items, returns the rows written. ``checkpoint`` is saved in the same transaction.
+        """
+        pending = {buy_model: buys for buy_model, buys in self.pending.items() if buys}
+        self.pending = {buy_model: [] for buy_model in self.pending}
+        if self.dry_run or not (rows or pending):
+            return 0
+        async with in_transaction():
+            for buy_model, buys in pending.items():
+                object_cache.evict(fk_tags(buy_model, buys) | {model_tag(buy_model)})
+                await buy_model.bulk_create(buys)
+                # Buys keep the ids of the source
+                await reset_sequences(buy_model)
+            if rows:
+                children = [model.pop_bw_relations(data) for data in rows]
+                objects = [model(**model.drop_zero_ids(data)) for data in rows]
+                object_cache.evict(fk_tags(model, objects) | {model_tag(model)})
+                ids = await model.bulk_create_ids(objects)
+                line_items, queries = await model.bulk_create_bw_relations(list(zip(ids, children)))
+                await refresh_totals(model, ids)
+                logger.debug(f"Wrote {len(objects)} {model.__name__} rows with {line_items} line items in {queries + 3} queries")
+            if checkpoint is not None:
+                await checkpoint.save(len(rows))
+        self.written += len(rows)
+        return len(rows)
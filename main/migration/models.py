@@ -0,0 +1,11 @@
+from tortoise import fields, models
+
+
+class MigrationCheckpoint(models.Model):
+    """Progress of an import, saved in the transaction of every batch it writes."""
+
+    source = fields.CharField(max_length=255, pk=True)
+    # Source rows consumed, after the skipped ones, by the committed batches
+    position = fields.IntField(default=0)
+    written = fields.IntField(default=0)
+    updated_at = fields.DatetimeField(auto_now=True)
@@ -0,0 +1,81 @@
+import csv
+from datetime import datetime
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional, Sequence, TypeVar
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+EXCEL_EPOCH = datetime(1900, 1, 1).toordinal() - 2
+TRUE_VALUES = ("verdadero", "true")
+
+
+def isfloat(value: Any) -> bool:
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def excel_date(value: str, formats: Sequence[str] = ("%d/%m/%Y",)) -> Optional[datetime]:
+    """Excel serial day numbers (as exported by the old system) or text in one of ``formats``."""
+    if isfloat(value):
+        return datetime.fromordinal(EXCEL_EPOCH + int(float(value)))
+    for date_format in formats:
+        try:
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def is_true(value: Optional[str]) -> bool:
+    return (value or "").lower() in TRUE_VALUES
+
+
+def read_csv(path: str, skip: int = 0) -> Iterator[dict]:
+    """Rows of the CSV at ``path`` as dicts keyed by its header, ``skip`` rows after the header are dropped."""
+    with open(path, "r", newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        headers = next(reader)
+        for number, row in enumerate(reader):
+            if number >= skip:
+                yield dict(zip(headers, row))
+
+
+def count_rows(path: str, skip: int = 0) -> int:
+    """Rows ``read_csv`` yields for ``path``, without keeping any of them."""
+    with open(path, "r", newline="") as csvfile:
+        return max(sum(1 for _ in csv.reader(csvfile)) - 1 - skip, 0)
+
+
+async def transform(items: Iterable[T], func: Callable[[T], Awaitable[Optional[R]]]) -> AsyncIterator[R]:
+    """Await ``func`` on every item, dropping the ones it rejects by returning None."""
+    for item in items:
+        result = await func(item)
+        if result is not None:
+            yield result
+
+
+async def batched(items: AsyncIterable[T], size: int) -> AsyncIterator[List[T]]:
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def run(batches: AsyncIterable[List[T]], write: Callable[[List[T]], Awaitable[Any]]) -> int:
+    """
+    Write every batch, the next one is only parsed once the previous write finished, so
+    no more than one batch is held in memory however large the source is.
+    """
+    rows = 0
+    async for batch in batches:
+        await write(batch)
+        rows += len(batch)
+    return rows
@@ -0,0 +1,69 @@
+import cProfile
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from jose import jwt
+from jose.exceptions import JWTError
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from main.logger import logger
+from main.metrics import endpoint_name
+from main.settings import settings
+
+
+PROFILE_DIR = Path(__file__).parent.absolute() / "logs/profiles"
+
+
+def _admin_token(headers: Headers) -> Optional[str]:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.hash_algorithm])
+    except JWTError:
+        return None
+    return payload.get("username") if payload.get("is_admin") else None
+
+
+class ProfilingMiddleware:
+    """
+    Runs admin requests carrying ``X-Profile: 1`` under cProfile and stores the result
+    as a pstats file in ``main/logs/profiles``, named in the ``X-Profile-File`` response
+    header. cProfile sees the whole event loop thread, so requests running at the same
+    time show up in the profile too, and only one request is profiled at a time.
+    Requests without the header only pay for the header lookup.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.profiling = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or (b"x-profile", b"1") not in scope["headers"] or self.profiling:
+            await self.app(scope, receive, send)
+            return
+        username = _admin_token(Headers(scope=scope))
+        if username is None:
+            await self.app(scope, receive, send)
+            return
+        endpoint = endpoint_name(scope)
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{endpoint}.prof"
+
+        async def profile_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-file", name.encode())]
+            await send(message)
+
+        self.profiling = True
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await self.app(scope, receive, profile_send)
+        finally:
+            profile.disable()
+            self.profiling = False
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(PROFILE_DIR / name)
+            logger.info("Stored profile of {} for {} in {}", endpoint, username, name)
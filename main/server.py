@@ -2,14 +2,17 @@ import logging
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from tortoise import Tortoise
 from tortoise.contrib.fastapi import register_tortoise
 
-from main.api.auth.permissions import generate_roles, generate_superuser
+from main.api.auth.permissions import compile_permissions, generate_roles, generate_superuser
 from main.api.auth.routes import router as auth_router
 from main.api.routes import router
 from main.settings import settings
 from main.logger import logger
+from main.metrics import METRICS_MEDIA_TYPE, MetricsMiddleware, instrument_connections, metrics
+from main.profiling import ProfilingMiddleware
 
 # logging.basicConfig(level=logging.DEBUG, format='%(levelname)s %(name)s %(message)s')
 
@@ -32,6 +35,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 register_tortoise(
     app,
@@ -44,7 +49,9 @@ register_tortoise(
 @app.on_event("startup")
 async def startup_event():
     logger.debug("Start up")
+    instrument_connections()
     await generate_roles()
+    compile_permissions(route.endpoint.__name__ for route in app.routes)
     if settings.admin_username and settings.admin_password:
         await generate_superuser(settings.admin_username, settings.admin_password)
 
@@ -58,3 +65,8 @@ async def shutdown_event():
 def root(request: Request):
     # import pdb; pdb.set_trace()
     return {"message": "Hello World"}
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type=METRICS_MEDIA_TYPE)
@@ -1,5 +1,7 @@
 import os
 
+from typing import Dict, Optional
+
 from pydantic import BaseSettings
 
 
@@ -14,6 +16,24 @@ class Settings(BaseSettings):
     admin_username: str = "user"
     admin_password: str = "secret"
     allow_origin: str = "http://localhost"
+    page_size: int = 100
+    max_page_size: int = 1000
+    # Distinct fields/include combinations built per process, each one is a new model
+    max_projections: int = 256
+    stream_chunk_size: int = 500
+    user_cache_size: int = 1024
+    user_cache_ttl: int = 60
+    password_hash_workers: int = os.cpu_count() or 1
+    log_mode: str = "development"
+    log_level: str = "DEBUG"
+    log_levels: Dict[str, str] = {}
+    log_rotation: str = "50 MB"
+    log_retention: str = "14 days"
+    log_compression: str = "gz"
+    slow_query_threshold: float = 0.5
+    object_cache_size: int = 512
+    # sqlite file shared by every worker, in process only when unset
+    object_cache_path: Optional[str] = None
 
 class TestSettings(BaseSettings):
     app_name: str = "Awesome API"
@@ -26,6 +46,24 @@ class TestSettings(BaseSettings):
     admin_username: str = "user"
     admin_password: str = "secret"
     allow_origin: str = "http://localhost"
+    page_size: int = 100
+    max_page_size: int = 1000
+    # Distinct fields/include combinations built per process, each one is a new model
+    max_projections: int = 256
+    stream_chunk_size: int = 500
+    user_cache_size: int = 1024
+    user_cache_ttl: int = 60
+    password_hash_workers: int = os.cpu_count() or 1
+    log_mode: str = "development"
+    log_level: str = "DEBUG"
+    log_levels: Dict[str, str] = {}
+    log_rotation: str = "50 MB"
+    log_retention: str = "14 days"
+    log_compression: str = "gz"
+    slow_query_threshold: float = 0.5
+    object_cache_size: int = 512
+    # sqlite file shared by every worker, in process only when unset
+    object_cache_path: Optional[str] = None
 
 settings = Settings()
 if os.getenv('ENVIRONMENT') == "testing":
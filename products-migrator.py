@@ -1,46 +1,38 @@
 import asyncio
-from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
 
-import tortoise
 from tortoise import Tortoise
+from tortoise.transactions import in_transaction
 
-from main.api.schemas import ApplianceSerializer, BrandSerializer, PercentageSerializer, ProductSerializer, ProviderSerializer
+from main.api.models import Appliance, Brand, Percentage, Product, Provider, Provider_Product
+from main.migration.bulk import bulk_load, reset_sequences
+from main.migration.dump import read_dump
 from main.settings import settings
 
-dry_run = False
 
-def isfloat(value):
-    try:
-        float(value)
-    except:
-        return False
-    return True
+class Loaded:
+    """Dump id -> id of the rows of one model, keyed by a unique value; new rows keep the dump id when it is free."""
 
-async def get_all(serializer):
-    model = serializer.__config__.orig_model
-    return await serializer.from_queryset(model.all())
+    def __init__(self, existing):
+        self.by_key = dict(existing)
+        self.taken = set(self.by_key.values())
+        self.top = max(self.taken, default=0)
+        self.ids = {}
 
+    def add(self, dump_id, key):
+        """Id for the dump row, None when a row with ``key`` is already there."""
+        if key in self.by_key:
+            self.ids[dump_id] = self.by_key[key]
+            return None
+        obj_id = dump_id
+        if obj_id in self.taken:
+            obj_id = self.top + 1
+        self.top = max(self.top, obj_id)
+        self.taken.add(obj_id)
+        self.by_key[key] = self.ids[dump_id] = obj_id
+        return obj_id
 
-async def get_one(serializer, **data):
-    model = serializer.__config__.orig_model
-    return await serializer.from_queryset_single(model.get(**data))
-
-async def filter_by(serializer, **filters):
-    model = serializer.__config__.orig_model
-    return await serializer.from_queryset(model.filter(**filters))
-
-async def create(serializer, **data):
-    model = serializer.__config__.orig_model
-    db_obj = await model.create(**data)
-    return await serializer.from_tortoise_orm(db_obj)
-
-async def update(serializer, obj_id, **data):
-    model = serializer.__config__.orig_model
-    qs = model.filter(id=obj_id)
-    await qs.update(**data)
-    if hasattr(qs, "update_bw_relations"):
-        await qs.update_bw_relations(obj_id)
-    return await serializer.from_queryset_single(model.get(id=obj_id))
 
 async def main():
     await Tortoise.init(
@@ -48,91 +40,53 @@ async def main():
         modules={'models': ['main.api.models']}
     )
 
-    products = {}
-    appliances = {}
-    brands = {}
-    providers = {}
-    provider_products = {}
-
-    with open('products-seed.sql', 'r') as sqlfile:
-        for line in sqlfile.readlines():
-            if line.startswith('INSERT INTO '):
-                model_name = line.split('`')[1]
-                if model_name == 'database_appliance':
-                    for row in line[41:-3].split("),("):
-                        _id, name = row.split(",")
-                        _id = int(_id)
-                        name = name.replace("'", "")
-                        # print(_id, name)
-                        try:
-                            appliances[_id] = (await create(ApplianceSerializer, **{"id":_id, "name":name}))
-                        except tortoise.exceptions.IntegrityError:
-                            appliances[_id] = (await get_one(ApplianceSerializer, name=name))
-                if model_name == 'database_brand':
-                    for row in line[37:-3].split("),("):
-                        _id, name = row.split(",")
-                        _id = int(_id)
-                        name = name.replace("'", "")
-                        # print(_id, name)
-                        try:
-                            brands[_id] = (await create(BrandSerializer, **{"id":_id, "name":name}))
-                        except tortoise.exceptions.IntegrityError:
-                            brands[_id] = (await get_one(BrandSerializer, name=name))
-                if model_name == 'database_provider':
-                    for row in line[40:-3].split("),("):
-                        _id, name = row.split(",")
-                        _id = int(_id)
-                        name = name.replace("'", "")
-                        # print(_id, name)
-                        try:
-                            providers[_id] = (await create(ProviderSerializer, **{"id":_id, "name":name}))
-                        except tortoise.exceptions.IntegrityError:
-                            providers[_id] = (await get_one(ProviderSerializer, name=name))
-                if model_name == 'database_percentage':
-                    for row in line[42:-3].split("),("):
-                        _id, mpl, increment, _, _, _, _, _ = row.split(",")
-                        _id = int(_id)
-                        # print(_id, mpl, increment)
-                        await create(PercentageSerializer, **{"id":_id, "max_price_limit":mpl, "increment": increment})
-                if model_name == 'database_product':
-                    for row in line[39:-3].split("),("):
-                        # print(row)
-                        try:
-                            _id, code, name, description, price, discount, appliance_id, brand_id, provider_id, picture = row.split(",")
-                        except ValueError:
-                            splitted = row.split(",")
-                            _id, code, name = splitted[:3]
-                            price, discount, appliance_id, brand_id, provider_id, picture = splitted[-6:]
-                            description = ",".join(splitted[3:-6])
-                        _id = int(_id)
-                        code = code.replace("'", "")
-                        name = name.replace("'", "")
-                        description = description.replace("'", "")
-                        price = float(price)
-                        discount = float(discount)
-                        appliance_id = int(appliance_id) if appliance_id.isdigit() else None
-                        brand_id = int(brand_id)
-                        provider_id = int(provider_id)
-                        picture = picture.replace("'", "")
-                        data = {
-                            "id":_id,
-                            "code": code,
-                            "name":name,
-                            "description":description,
-                            "brand_id":brands[brand_id].id
-                        }
-                        if appliance_id:
-                            data["appliance_id"] = appliances[appliance_id].id
-                        products[_id] = (await create(ProductSerializer, **data))
-                        if not providers[provider_id].id in provider_products.keys():
-                            provider_products[providers[provider_id].id] = []
-                        provider_products[providers[provider_id].id].append({"code": products[_id].code, "product_id":products[_id].id, "price":price, "discount":discount})
-                # print(model_name)
-
-    for p_id, pp in provider_products.items():
-        await update(ProviderSerializer, p_id, **{"provider_products":pp})
+    appliances = Loaded(await Appliance.all().values_list("name", "id"))
+    brands = Loaded(await Brand.all().values_list("name", "id"))
+    providers = Loaded(await Provider.all().values_list("name", "id"))
+    percentages = Loaded(await Percentage.all().values_list("max_price_limit", "id"))
+    products = Loaded(await Product.all().values_list("code", "id"))
+    existing_provider_products = set(await Provider_Product.all().values_list("provider_id", "code"))
+    provider_products = []
+
+    def named_rows(loaded, rows):
+        for _, (_id, name) in rows:
+            obj_id = loaded.add(_id, name)
+            if obj_id is not None:
+                yield obj_id, name
+
+    def percentage_rows(rows):
+        for _, (_id, mpl, increment, *_) in rows:
+            obj_id = percentages.add(_id, mpl)
+            if obj_id is not None:
+                yield obj_id, mpl, float(increment)
+
+    def product_rows(rows):
+        for _, (_id, code, name, description, price, discount, appliance_id, brand_id, provider_id, picture) in rows:
+            obj_id = products.add(_id, code)
+            if obj_id is not None:
+                yield obj_id, code, name, description, brands.ids[brand_id], appliances.ids.get(appliance_id)
+            provider_id = providers.ids[provider_id]
+            if (provider_id, code) not in existing_provider_products:
+                existing_provider_products.add((provider_id, code))
+                provider_products.append((code, provider_id, products.ids[_id], price))
+
+    # The dump inserts parents before their children
+    loaders = {
+        'database_appliance': (Appliance, ("id", "name"), lambda rows: named_rows(appliances, rows)),
+        'database_brand': (Brand, ("id", "name"), lambda rows: named_rows(brands, rows)),
+        'database_provider': (Provider, ("id", "name"), lambda rows: named_rows(providers, rows)),
+        'database_percentage': (Percentage, ("id", "max_price_limit", "increment"), percentage_rows),
+        'database_product': (Product, ("id", "code", "name", "description", "brand_id", "appliance_id"), product_rows),
+    }
+    loaded = {}
+    async with in_transaction():
+        for table, rows in groupby(read_dump('products-seed.sql', loaders), key=itemgetter(0)):
+            model, fields, parse = loaders[table]
+            loaded[model.__name__] = loaded.get(model.__name__, 0) + await bulk_load(model, fields, parse(rows))
+        loaded[Provider_Product.__name__] = await bulk_load(Provider_Product, ("code", "provider_id", "product_id", "price"), provider_products)
+        await reset_sequences(Appliance, Brand, Provider, Percentage, Product, Provider_Product)
+    print(loaded)
 
-    # import pdb; pdb.set_trace()
     await Tortoise.close_connections()
 
-asyncio.run(main())
\ No newline at end of file
+asyncio.run(main())
@@ -1,236 +1,104 @@
 import asyncio
-import csv
-from datetime import datetime
 
 from tortoise import Tortoise
 
-from main.api.schemas import CustomerSerializer, EmployeeSerializer, OrganizationSerializer, ProductSerializer, ProviderSerializer, StorageBuySerializer, StorageSerializer, StorageTypeSerializer, TaxPayerSerializer
+from main.api.models import Order
+from main.migration.checkpoint import Checkpoint
+from main.migration.loader import MigrationLoader
+from main.migration.pipeline import batched, count_rows, excel_date, isfloat, read_csv, run, transform
 from main.settings import settings
 
 dry_run = False
+# Import the whole file again instead of resuming after the last committed batch
+restart = False
+batch_size = 500
 
-def isfloat(value):
-    try:
-        float(value)
-    except:
-        return False
-    return True
-
-async def get_all(serializer):
-    model = serializer.__config__.orig_model
-    return await serializer.from_queryset(model.all())
-
-async def filter_by(serializer, **filters):
-    model = serializer.__config__.orig_model
-    db_obj = model.filter(**filters)
-    # try:
-    #     return await serializer.from_queryset(db_obj)
-    # except Exception as e:
-    #     import pdb; pdb.set_trace()
-    #     raise e
-    return await serializer.from_queryset(db_obj)
-
-async def create(serializer, **data):
-    model = serializer.__config__.orig_model
-    try:
-        db_obj = await model.create(**data)
-    except Exception as e:
-        import pdb; pdb.set_trace()
-        raise e
-    return await serializer.from_tortoise_orm(db_obj)
-
-async def update(serializer, obj_id, **data):
-    model = serializer.__config__.orig_model
-    qs = model.filter(id=obj_id)
-    await qs.update(**data)
-    if hasattr(qs, "update_bw_relations"):
-        await qs.update_bw_relations(obj_id)
-    return await serializer.from_queryset_single(model.get(id=obj_id))
 
 async def main():
     await Tortoise.init(
         db_url=settings.db_url,
-        modules={'models': ['main.api.models']}
+        modules={'models': ['main.api.models', 'main.migration.models']}
     )
+    await Tortoise.generate_schemas(safe=True)
 
-    # all_providers = await get_all(ProviderSerializer)
-    # all_employees = await get_all(EmployeeSerializer)
-    # all_organizations = await get_all(OrganizationSerializer)
-    # all_taxpayers = await get_all(TaxPayerSerializer)
-
-    storagebuys = {}
-    ups_count = {}
-    ups = {}
-
-    # providers = set()
-    # taxpayers = set()
-    # customers = set()
-    # organizations = set()
-    # employees = set()
-    # invoices = set()
-
-    failures = 0
-
-    stotype_id = None
-    if not dry_run:
-        stotype_q = await filter_by(StorageTypeSerializer, name="CONSIGNACION")
-        if stotype_q:
-            stotype_id = stotype_q[0].id
-        else:
-            stotype_id = (await create(StorageTypeSerializer, name="CONSIGNACION")).id
+    try:
+        skip = 0
+        checkpoint = await Checkpoint('storagebuys.csv', count_rows('storagebuys.csv', skip), dry_run=dry_run).load(restart)
 
-    with open('storagebuys.csv', 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        headers = next(reader)
-        for row in reader:
-            w = dict(zip(headers, row))
-            if w.get('FECHA') and isfloat(w.get('HOJA', "")) and w.get('ORG') and w.get('OC') and w['ORG'] != 'X':
-                w_id = int(w['HOJA'])
-                if isfloat(w['FECHA']):
-                    w_date = datetime.fromordinal(datetime(1900, 1, 1).toordinal() + int(w['FECHA']) - 2)
-                elif w['FECHA']:
-                    w_date = datetime.strptime(w['FECHA'], '%d/%m/%Y')
-                provider = None
-                cust_id = None
-                org_id = None
-                prov_id = None
-                tp_id = None
-                empl_id = None
-                sto_id = None
-                comment = w.get('OBSERVACION')
-                if comment == '0':
-                    comment = ''
-                discount = 0.0
-                w_price = 0.0
-                order_unregisteredproducts = []
-                order_provider_products = []
-                customer_query = await filter_by(CustomerSerializer, name=w['EMPRESA'] if w['EMPRESA'] else 'DESCONOCIDO')
-                if customer_query:
-                    cust_id = customer_query[0].id
-                elif not dry_run:
-                    cust_id = (await create(CustomerSerializer, name=w['EMPRESA'] if w['EMPRESA'] else 'DESCONOCIDO')).id
-                organization_query = await filter_by(OrganizationSerializer, prefix=w["OC"][0])
-                if organization_query:
-                    org_id = organization_query[0].id
-                else:
-                    organization_query = await filter_by(OrganizationSerializer, name=w["ORG"])
-                    if organization_query:
-                        org_id = organization_query[0].id
-                if not organization_query and not dry_run:
-                    org_id = (await create(OrganizationSerializer, name=w['ORG'], prefix=w["OC"][0])).id
-                if not dry_run:
-                    storage_query = await filter_by(StorageSerializer, organization_id=org_id, storagetype_id=stotype_id)
-                    if storage_query:
-                        sto_id = storage_query[0].id
-                    else:
-                        sto_id = (await create(StorageSerializer, organization_id=org_id, storagetype_id=stotype_id)).id
-                provider_query = await filter_by(ProviderSerializer, name=w['Proveedor'] if w['Proveedor'] else 'DESCONOCIDO')
-                if provider_query:
-                    provider = provider_query[0]
-                    prov_id = provider.id
-                elif not dry_run:
-                    provider = await create(ProviderSerializer, name=w['Proveedor'] if w['Proveedor'] else 'DESCONOCIDO')
-                    prov_id = provider.id
-                taxpayer_query = await filter_by(TaxPayerSerializer, name=w['RAZON SOCIAL'] if w['RAZON SOCIAL'] else 'MUELLES OBRERO')
-                if taxpayer_query:
-                    tp_id = taxpayer_query[0].id
-                elif not dry_run:
-                    tp_id = (await create(TaxPayerSerializer, name=w['RAZON SOCIAL'] if w['RAZON SOCIAL'] else 'MUELLES OBRERO', key=w['RAZON SOCIAL'][:4]+"010195XYZ" if w['RAZON SOCIAL'] else 'ABCD010195XYZ')).id
-                if w['COMPRA'] != '0':
-                    employee_query = await filter_by(EmployeeSerializer, name=w['COMPRA'])
-                    if employee_query:
-                        empl_id = employee_query[0].id
-                    elif not dry_run:
-                        empl_id = (await create(EmployeeSerializer, name=w['COMPRA'])).id
-                for i in range(24):
-                    if isfloat(w.get(str(i+1)+'_CANT', "")) and isfloat(w.get(str(i+1)+'_IMPORTE', "")) and int(w.get(str(i+1)+'_CANT')) > 0:
-                        w_price += (float(w[str(i+1)+'_IMPORTE'])*int(w[str(i+1)+'_CANT']))
-                        product_query = await filter_by(ProductSerializer, code=w[str(i+1)+'_COD'])
-                        if product_query:
-                            pp_id = None
-                            provider_query = await filter_by(ProviderSerializer, name=w['Proveedor'])
-                            if provider_query:
-                                provider = provider_query[0]
-                                # import pdb; pdb.set_trace()
-                                for pp in provider.provider_products:
-                                    if pp.product.id == product_query[0].id:
-                                        pp_id = pp.id
-                                        break
-                            if not pp_id and not dry_run:
-                                new_pp = []
-                                for pp in provider.provider_products:
-                                    new_pp.append({'id': pp.id})
-                                new_pp.append({"product_id":product_query[0].id, "price":float(w[str(i+1)+'_IMPORTE']), "code":product_query[0].code})
-                                await update(ProviderSerializer, provider.id, **{"provider_products":new_pp})
-                                provider_query = await filter_by(ProviderSerializer, name=w['Proveedor'])
-                                for pp in provider_query[0].provider_products:
-                                    if pp.product.id == product_query[0].id:
-                                        pp_id = pp.id
-                                        break
-                            if not dry_run and provider and not pp_id:
-                                import pdb; pdb.set_trace()
-                            order_provider_products.append({
-                                'provider_product_id': pp_id,
-                                'amount': int(w[str(i+1)+'_CANT']),
-                                'price': float(w[str(i+1)+'_IMPORTE']),
-                            })
-                        else:
-                            if float(w[str(i+1)+'_IMPORTE']) < 0.0:
-                                discount = float(w[str(i+1)+'_IMPORTE']) * -1
-                            else:
-                                if w[str(i+1)+'_COD'] and w[str(i+1)+'_COD'] != "0":
-                                    if w[str(i+1)+'_COD'] not in ups_count:
-                                        ups_count[w[str(i+1)+'_COD']] = 0
-                                        ups[w[str(i+1)+'_COD']] = set()
-                                    ups_count[w[str(i+1)+'_COD']] += 1
-                                    ups[w[str(i+1)+'_COD']].add(w[str(i+1)+'_REFA'])
-                                order_unregisteredproducts.append({
-                                    'code': w[str(i+1)+'_COD'],
-                                    'description': w[str(i+1)+'_REFA'],
-                                    'amount': int(w[str(i+1)+'_CANT']),
-                                    'price': float(w[str(i+1)+'_IMPORTE']),
-                                })
-                w_price = float("{:.2f}".format(w_price))
-                if isfloat(w.get('IVA')):
-                    iva = float("{:.2f}".format(float(w.get('IVA'))))
-                w_iva = True if iva else False
-                # impo = 0.0
-                # if isfloat(w.get('IMPORETE')):
-                #     impo = float("{:.2f}".format(float(w.get('IMPORETE'))))
-                # if not w_price == impo:
-                #     print(w_id)
-                #     print(w_price == impo, w.get('IMPORETE'), w_price)
+        loader = await MigrationLoader(dry_run=dry_run).load()
+        stotype_id = await loader.storagetypes.get("CONSIGNACION")
+        failures = 0
 
-                if not w_id in storagebuys.keys():
-                    storagebuys[w_id] = {
-                        'id': w_id,
-                        'created_at': w_date,
-                        'customer_id': cust_id,
-                        'organization_id': org_id,
-                        'storage_id': sto_id,
-                        'orders': []
-                    }
-                storagebuys[w_id]['orders'].append({
-                    'created_at': w_date,
-                    'provider_id': prov_id,
-                    'taxpayer_id': tp_id,
-                    'claimant_id': empl_id,
-                    'include_iva': w_iva,
-                    'discount': discount,
-                    'comment': comment,
-                    'order_unregisteredproducts': order_unregisteredproducts,
-                    'order_provider_products': order_provider_products
-                })
-            else:
+        async def order_from_row(w):
+            nonlocal failures
+            if not (w.get('FECHA') and isfloat(w.get('HOJA', "")) and w.get('ORG') and w.get('OC') and w['ORG'] != 'X'):
                 failures += 1
-
-    print(failures)
-
-    if not dry_run:
-        for w_id, wb in storagebuys.items():
-            await create(StorageBuySerializer, **wb)
-    else:
-        import pdb; pdb.set_trace()
-    await Tortoise.close_connections()
-
-asyncio.run(main())
\ No newline at end of file
+                return None
+            w_date = excel_date(w['FECHA'])
+            cust_id = await loader.customers.get(w['EMPRESA'] if w['EMPRESA'] else 'DESCONOCIDO')
+            org_id = await loader.organization(w['ORG'], w["OC"][0], by_prefix=True)
+            sto_id = await loader.storage(org_id, stotype_id)
+            # Every row is an order, the first one of each HOJA creates its storagebuy
+            sb_id = await loader.storagebuy(int(w['HOJA']), w_date, cust_id, org_id, sto_id)
+            prov_id = await loader.providers.get(w['Proveedor'] if w['Proveedor'] else 'DESCONOCIDO')
+            tp_name = w['RAZON SOCIAL'] if w['RAZON SOCIAL'] else 'MUELLES OBRERO'
+            tp_id = await loader.taxpayers.get(tp_name, key=w['RAZON SOCIAL'][:4]+"010195XYZ" if w['RAZON SOCIAL'] else 'ABCD010195XYZ')
+            empl_id = None
+            if w['COMPRA'] != '0':
+                empl_id = await loader.employees.get(w['COMPRA'])
+            comment = w.get('OBSERVACION')
+            if comment == '0':
+                comment = ''
+            discount = 0.0
+            order_unregisteredproducts = []
+            order_provider_products = []
+            for i in range(1, 25):
+                code = w.get(f'{i}_COD', "")
+                amount = w.get(f'{i}_CANT', "")
+                price = w.get(f'{i}_IMPORTE', "")
+                if not (isfloat(amount) and isfloat(price) and int(amount) > 0):
+                    continue
+                product_id = loader.products.find(code)
+                if product_id:
+                    order_provider_products.append({
+                        'provider_product_id': await loader.provider_product(prov_id, product_id, float(price), code),
+                        'amount': int(amount),
+                        'price': float(price),
+                    })
+                elif float(price) < 0.0:
+                    discount = float(price) * -1
+                else:
+                    order_unregisteredproducts.append({
+                        'code': code,
+                        'description': w[f'{i}_REFA'],
+                        'amount': int(amount),
+                        'price': float(price),
+                    })
+            iva = None
+            if isfloat(w.get('IVA')):
+                iva = float("{:.2f}".format(float(w.get('IVA'))))
+            return {
+                'created_at': w_date,
+                'storagebuy_id': sb_id,
+                'provider_id': prov_id,
+                'taxpayer_id': tp_id,
+                'claimant_id': empl_id,
+                'include_iva': bool(iva),
+                'discount': discount,
+                'comment': comment,
+                'order_unregisteredproducts': order_unregisteredproducts,
+                'order_provider_products': order_provider_products
+            }
+
+        async def write(batch):
+            await loader.write(Order, batch, checkpoint)
+            checkpoint.report()
+
+        rows = checkpoint.track(read_csv('storagebuys.csv', skip + checkpoint.position))
+        await run(batched(transform(rows, order_from_row), batch_size), write)
+        await checkpoint.save()
+        print(failures, checkpoint.written)
+    finally:
+        await Tortoise.close_connections()
+
+asyncio.run(main())
@@ -1,13 +1,32 @@
+import asyncio
 import json
 import os
 import importlib
+import pstats
+import sqlite3
 from copy import copy
+from datetime import datetime
+from decimal import Decimal
 
 from fastapi.testclient import TestClient
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
 
 os.environ['ENVIRONMENT'] = 'testing'
 os.remove('test.sqlite3')
 
+from main.api import projection
+from main.api.cache import ObjectCache, SqliteStore
+from main.api.models import Brand, Customer, Organization, TaxPayer, Work, WorkBuy
+from main.api.auth.permissions import ENDPOINT_PERMS, ROLE_BUYER, compile_permissions
+from main.logger import logger
+from main.migration.bulk import bulk_load
+from main.migration.checkpoint import Checkpoint
+from main.migration.dump import read_dump
+from main.migration.loader import MigrationLoader
+from main.migration.models import MigrationCheckpoint
+from main.migration.pipeline import batched, count_rows, read_csv, run, transform
+from main.profiling import PROFILE_DIR
 from main.server import app
 from main.settings import settings
 
@@ -148,4 +167,909 @@ class TestWorkBuy(TestAPI):
             assert result["orders"][0]["order_unregisteredproducts"][1]["description"] == update_data["orders"][0]["order_unregisteredproducts"][1]["description"]
             assert result["orders"][0]["order_unregisteredproducts"][1]["amount"] == update_data["orders"][0]["order_unregisteredproducts"][1]["amount"]
             assert result["orders"][0]["order_unregisteredproducts"][1]["price"] is None
-            
\ No newline at end of file
+            
+
+class TestPagination(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+        with TestClient(app) as client:
+            for i in range(5):
+                response = client.post("/appliance", json={"name": f"PageAppliance{i}"}, headers={
+                    "Authorization": f"Bearer {cls.token}",
+                })
+                assert response.status_code == 200
+
+    def test_cursor_pages(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/appliance", headers=headers)
+            assert response.status_code == 200
+            all_ids = [a["id"] for a in sorted(response.json(), key=lambda a: a["id"])]
+            seen = []
+            after = None
+            while True:
+                url = "/appliance?limit=2" + (f"&after={after}" if after else "")
+                response = client.get(url, headers=headers)
+                assert response.status_code == 200
+                page = response.json()
+                assert len(page["items"]) <= 2
+                seen += [a["id"] for a in page["items"]]
+                after = page["next_cursor"]
+                if not after:
+                    break
+            assert seen == all_ids
+
+    def test_invalid_cursor(self):
+        with TestClient(app) as client:
+            response = client.get("/appliance?limit=2&after=notacursor", headers={
+                "Authorization": f"Bearer {self.token}",
+            })
+            assert response.status_code == 400
+
+    def test_ndjson_stream(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/appliance", headers=headers)
+            expected = sorted(a["id"] for a in response.json())
+            response = client.get("/appliance", headers={**headers, "Accept": "application/x-ndjson"})
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("application/x-ndjson")
+            lines = [json.loads(line) for line in response.text.splitlines() if line]
+            assert [a["id"] for a in lines] == expected
+
+
+class TestProjection(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+        with TestClient(app) as client:
+            response = client.post("/provider", json={"name": "ProjectionProvider"}, headers={
+                "Authorization": f"Bearer {cls.token}",
+            })
+            assert response.status_code == 200
+            cls.provider_id = response.json()["id"]
+
+    def test_fields(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get(f"/provider/{self.provider_id}?fields=name", headers=headers)
+            assert response.status_code == 200
+            assert response.json() == {"id": self.provider_id, "name": "ProjectionProvider"}
+            response = client.get("/provider?fields=name&include=provider_products", headers=headers)
+            assert response.status_code == 200
+            provider = [p for p in response.json() if p["id"] == self.provider_id][0]
+            assert set(provider.keys()) == {"id", "name", "provider_products"}
+
+    def test_unknown_field(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/provider?fields=bogus", headers=headers)
+            assert response.status_code == 400
+            response = client.get("/provider?include=orders", headers=headers)
+            assert response.status_code == 400
+
+    def test_projection_limit(self, monkeypatch):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get(f"/provider/{self.provider_id}?fields=name", headers=headers)
+            assert response.status_code == 200
+            monkeypatch.setattr(settings, "max_projections", len(projection._projections))
+            # Same projection as above
+            response = client.get(f"/provider/{self.provider_id}?fields=name,id,name", headers=headers)
+            assert response.status_code == 200
+            assert response.json() == {"id": self.provider_id, "name": "ProjectionProvider"}
+            response = client.get(f"/provider/{self.provider_id}?fields=id", headers=headers)
+            assert response.status_code == 400
+
+    def test_summary(self):
+        with TestClient(app) as client:
+            response = client.get("/provider?summary=true", headers={
+                "Authorization": f"Bearer {self.token}",
+            })
+            assert response.status_code == 200
+            provider = [p for p in response.json() if p["id"] == self.provider_id][0]
+            assert provider["products_amount"] == 0
+            assert "provider_products" not in provider
+
+
+class TestTotals(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+        headers = {"Authorization": f"Bearer {cls.token}"}
+        with TestClient(app) as client:
+            customer = client.post("/customer", json={"name": "TotalsCustomer"}, headers=headers).json()
+            organization = client.post("/organization", json={"name": "TotalsOrganization", "prefix": "T"}, headers=headers).json()
+            taxpayer = client.post("/taxpayer", json={"name": "TotalsTaxPayer", "key": "TOTA010195XYZ"}, headers=headers).json()
+            provider = client.post("/provider", json={"name": "TotalsProvider"}, headers=headers).json()
+            response = client.post("/workbuy", json={
+                "customer_id": customer["id"],
+                "organization_id": organization["id"],
+                "orders": [
+                    {
+                        "provider_id": provider["id"],
+                        "taxpayer_id": taxpayer["id"],
+                        "include_iva": True,
+                        "discount": 1.5,
+                        "order_unregisteredproducts": [
+                            {"description": "Desc1", "amount": 3, "price": 2.25},
+                            {"description": "Desc2", "amount": 1, "price": 10},
+                        ]
+                    },
+                    {
+                        "provider_id": provider["id"],
+                        "taxpayer_id": taxpayer["id"],
+                    }
+                ],
+                "works": [
+                    {
+                        "number": "T1",
+                        "taxpayer_id": taxpayer["id"],
+                        "include_iva": True,
+                        "work_unregisteredproducts": [
+                            {"description": "Desc3", "amount": 2, "price": 40},
+                        ]
+                    }
+                ]
+            }, headers=headers)
+            assert response.status_code == 200
+            cls.workbuy = response.json()
+            cls.customer_id = customer["id"]
+            cls.organization_id = organization["id"]
+
+    def test_workbuy_summary(self):
+        with TestClient(app) as client:
+            response = client.get("/workbuy?summary=true", headers={
+                "Authorization": f"Bearer {self.token}",
+            })
+            assert response.status_code == 200
+            workbuy = [w for w in response.json() if w["id"] == self.workbuy["id"]][0]
+            assert "orders" not in workbuy
+            for key in ("orders_number", "works_number", "total", "works_total", "earnings"):
+                assert workbuy[key] == self.workbuy[key]
+
+    def test_order_summary(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            full = client.get(f"/order?workbuy_ids={self.workbuy['id']}", headers=headers).json()
+            response = client.get(f"/order?workbuy_ids={self.workbuy['id']}&summary=true", headers=headers)
+            assert response.status_code == 200
+            summary = response.json()
+            assert [(o["subtotal"], o["total"]) for o in summary] == [(o["subtotal"], o["total"]) for o in full]
+            assert "order_unregisteredproducts" not in summary[0]
+
+    def test_stored_totals_follow_updates(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            order = self.workbuy["orders"][1]
+            response = client.put(f"/order/{order['id']}", json={
+                "order_unregisteredproducts": [
+                    {"description": "Desc4", "amount": 2, "price": 5},
+                ]
+            }, headers=headers)
+            assert response.status_code == 200
+            full = client.get(f"/workbuy/{self.workbuy['id']}", headers=headers).json()
+            summary = [w for w in client.get("/workbuy?summary=true", headers=headers).json() if w["id"] == self.workbuy["id"]][0]
+            assert summary["total"] == full["total"] == self.workbuy["total"] + 10
+            assert summary["earnings"] == full["earnings"]
+
+    def test_stored_totals_follow_moves(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            workbuys = [client.post("/workbuy", json={
+                "customer_id": self.customer_id,
+                "organization_id": self.organization_id,
+                "works": works,
+            }, headers=headers).json() for works in ([{
+                "number": "T2",
+                "taxpayer_id": self.workbuy["works"][0]["taxpayer"]["id"],
+                "work_unregisteredproducts": [{"description": "Desc5", "amount": 1, "price": 10}],
+            }], [])]
+            moved_id = workbuys[0]["works"][0]["id"]
+            # The summary reads the stored columns
+            summary = lambda: {w["id"]: w["works_total"] for w in client.get("/workbuy?summary=true", headers=headers).json()}
+            totals = lambda: [summary()[w["id"]] for w in workbuys]
+            assert totals() == [10, 0]
+            response = client.patch(f"/work/{moved_id}", data=json.dumps({"workbuy_id": workbuys[1]["id"]}), headers={
+                **headers, "Content-Type": "application/merge-patch+json",
+            })
+            assert response.status_code == 200
+            assert totals() == [0, 10]
+            response = client.patch(f"/workbuy/{workbuys[1]['id']}", data=json.dumps([
+                {"op": "replace", "path": "/works/0/workbuy_id", "value": workbuys[0]["id"]},
+            ]), headers={**headers, "Content-Type": "application/json-patch+json"})
+            assert response.status_code == 200
+            assert totals() == [10, 0]
+
+    def test_stored_totals_follow_cascades(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            taxpayer_id = self.workbuy["works"][0]["taxpayer"]["id"]
+            providers = [client.post("/provider", json={"name": name}, headers=headers).json() for name in ("CascadeProvider1", "CascadeProvider2")]
+            # POST /product does not resolve brand_name yet
+            with sqlite3.connect("test.sqlite3") as connection:
+                product = {"id": connection.execute("INSERT INTO product (code, name) VALUES ('CASCADE1', 'CascadeProduct')").lastrowid}
+            workbuy = client.post("/workbuy", json={
+                "customer_id": self.customer_id,
+                "organization_id": self.organization_id,
+                "orders": [{
+                    "provider_id": provider["id"],
+                    "taxpayer_id": taxpayer_id,
+                    "order_unregisteredproducts": [{"description": "Desc6", "amount": 1, "price": price}],
+                } for provider, price in zip(providers, (5, 10))],
+                "works": [{
+                    "number": "T4",
+                    "taxpayer_id": taxpayer_id,
+                    "work_products": [{"product_id": product["id"], "amount": 1, "price": 20}],
+                    "work_unregisteredproducts": [{"description": "Desc7", "amount": 1, "price": 40}],
+                }],
+            }, headers=headers).json()
+            # The summary reads the stored columns
+            summary = lambda: next(w for w in client.get("/workbuy?summary=true", headers=headers).json() if w["id"] == workbuy["id"])
+            assert (summary()["total"], summary()["works_total"]) == (15, 60)
+            # Takes the first order with it
+            response = client.delete(f"/provider/{providers[0]['id']}", headers=headers)
+            assert response.status_code == 200
+            # Product has no APIManager, takes the work's product line with it
+            response = client.delete(f"/product/{product['id']}", headers=headers)
+            assert response.status_code == 200
+            assert (summary()["total"], summary()["works_total"], summary()["earnings"]) == (10, 40, 30)
+
+    def test_stored_totals_follow_nested_lines(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            order = self.workbuy["orders"][0]
+            lines = lambda *prices: [{"description": "Desc6", "amount": 1, "price": price} for price in prices]
+            workbuy = client.post("/workbuy", json={
+                "customer_id": self.customer_id,
+                "organization_id": self.organization_id,
+                "orders": [{
+                    "provider_id": order["provider"]["id"],
+                    "taxpayer_id": order["taxpayer"]["id"],
+                    "order_unregisteredproducts": lines(price),
+                } for price in (3, 7)],
+            }, headers=headers).json()
+            response = client.put(f"/workbuy/{workbuy['id']}", json={
+                "orders": [
+                    {"id": workbuy["orders"][0]["id"], "order_unregisteredproducts": lines(5, 6)},
+                    {"id": workbuy["orders"][1]["id"]},
+                ],
+                "works": [],
+            }, headers=headers)
+            assert response.status_code == 200
+            orders = client.get(f"/order?workbuy_ids={workbuy['id']}&summary=true", headers=headers).json()
+            assert [o["total"] for o in orders] == [11, 7]
+            summary = [w for w in client.get("/workbuy?summary=true", headers=headers).json() if w["id"] == workbuy["id"]][0]
+            assert summary["total"] == 18
+
+    def test_nested_create_is_atomic(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            before = client.get("/workbuy", headers=headers).json()
+            response = client.post("/workbuy", json={
+                "customer_id": self.customer_id,
+                "organization_id": self.organization_id,
+                "orders": [
+                    {"provider_id": 999999, "taxpayer_id": self.workbuy["orders"][0]["taxpayer"]["id"]},
+                ]
+            }, headers=headers)
+            assert response.status_code == 422
+            assert client.get("/workbuy", headers=headers).json() == before
+
+    def test_nested_update_reconciles(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            orders = self.workbuy["orders"]
+            response = client.put(f"/workbuy/{self.workbuy['id']}", json={
+                "orders": [
+                    {"id": orders[0]["id"], "state": "B"},
+                ],
+                "works": [
+                    {"id": work["id"]} for work in self.workbuy["works"]
+                ]
+            }, headers=headers)
+            assert response.status_code == 200
+            workbuy = response.json()
+            assert [(o["id"], o["state"]) for o in workbuy["orders"]] == [(orders[0]["id"], "B")]
+            assert workbuy["orders"][0]["total"] == orders[0]["total"]
+            assert [w["id"] for w in workbuy["works"]] == [w["id"] for w in self.workbuy["works"]]
+
+
+class TestPatch(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+        headers = {"Authorization": f"Bearer {cls.token}"}
+        with TestClient(app) as client:
+            taxpayer = client.post("/taxpayer", json={"name": "PatchTaxPayer", "key": "PATC010195XYZ"}, headers=headers).json()
+            provider = client.post("/provider", json={"name": "PatchProvider"}, headers=headers).json()
+            response = client.post("/order", json={
+                "provider_id": provider["id"],
+                "taxpayer_id": taxpayer["id"],
+                "order_unregisteredproducts": [
+                    {"description": "Desc1", "amount": 1, "price": 10},
+                    {"description": "Desc2", "amount": 2, "price": 5},
+                ]
+            }, headers=headers)
+            assert response.status_code == 200
+            cls.order = response.json()
+
+    def test_merge_patch(self):
+        with TestClient(app) as client:
+            response = client.patch(f"/order/{self.order['id']}", data=json.dumps({"comment": "Patched", "state": "B"}), headers={
+                "Authorization": f"Bearer {self.token}",
+                "Content-Type": "application/merge-patch+json",
+            })
+            assert response.status_code == 200
+            order = response.json()
+            assert (order["comment"], order["state"]) == ("Patched", "B")
+            assert order["order_unregisteredproducts"] == self.order["order_unregisteredproducts"]
+
+    def test_json_patch(self):
+        with TestClient(app) as client:
+            response = client.patch(f"/order/{self.order['id']}", data=json.dumps([
+                {"op": "test", "path": "/order_unregisteredproducts/1/description", "value": "Desc2"},
+                {"op": "replace", "path": "/order_unregisteredproducts/1/amount", "value": 3},
+                {"op": "add", "path": "/order_unregisteredproducts/-", "value": {"description": "Desc3", "amount": 1, "price": 1}},
+            ]), headers={
+                "Authorization": f"Bearer {self.token}",
+                "Content-Type": "application/json-patch+json",
+            })
+            assert response.status_code == 200
+            lines = response.json()["order_unregisteredproducts"]
+            assert [(line["description"], line["amount"]) for line in lines] == [("Desc1", 1), ("Desc2", 3), ("Desc3", 1)]
+            assert lines[:2] == [self.order["order_unregisteredproducts"][0], {**self.order["order_unregisteredproducts"][1], "amount": 3}]
+            assert response.json()["total"] == 26
+
+    def test_invalid_patch(self):
+        with TestClient(app) as client:
+            headers = {
+                "Authorization": f"Bearer {self.token}",
+                "Content-Type": "application/json-patch+json",
+            }
+            response = client.patch(f"/order/{self.order['id']}", data=json.dumps([{"op": "replace", "path": "/total", "value": 1}]), headers=headers)
+            assert response.status_code == 422
+            response = client.patch(f"/order/{self.order['id']}", data=json.dumps([{"op": "remove", "path": "/order_unregisteredproducts/9"}]), headers=headers)
+            assert response.status_code == 422
+
+    def test_patch_is_validated(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            merge = {**headers, "Content-Type": "application/merge-patch+json"}
+            for patch in ({"authorized": None}, {"taxpayer": None}):
+                response = client.patch(f"/order/{self.order['id']}", data=json.dumps(patch), headers=merge)
+                assert response.status_code == 422
+            lines = client.get(f"/order/{self.order['id']}", headers=headers).json()["order_unregisteredproducts"]
+            response = client.patch(f"/order/{self.order['id']}", data=json.dumps([
+                {"op": "replace", "path": "/order_unregisteredproducts/0/amount", "value": "many"},
+                {"op": "add", "path": "/order_unregisteredproducts/-", "value": {"amount": 1, "price": 1}},
+            ]), headers={**headers, "Content-Type": "application/json-patch+json"})
+            assert response.status_code == 422
+            locs = [error["loc"] for error in response.json()["detail"]]
+            assert ["order_unregisteredproducts", 0, "amount"] in locs
+            assert ["order_unregisteredproducts", len(lines), "description"] in locs
+            response = client.get(f"/order/{self.order['id']}", headers=headers)
+            assert response.json()["order_unregisteredproducts"] == lines
+
+    def test_return_minimal(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.put(f"/order/{self.order['id']}", json={"comment": "Minimal"}, headers={
+                **headers,
+                "Prefer": "return=minimal",
+            })
+            assert response.status_code == 200
+            assert response.headers["Preference-Applied"] == "return=minimal"
+            order = response.json()
+            assert set(order.keys()) == {"id", "subtotal", "total"}
+            response = client.get(f"/order/{self.order['id']}", headers={**headers, "If-None-Match": response.headers["etag"]})
+            assert response.status_code == 304
+            response = client.post("/provider?return=id", json={"name": "MinimalProvider"}, headers=headers)
+            assert response.status_code == 200
+            assert set(response.json().keys()) == {"id"}
+
+
+class TestUserCache(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+
+    def test_delete_invalidates(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.post("/user", json={"username": "cacheduser", "password": "secret"}, headers=headers)
+            assert response.status_code == 200
+            user_id = response.json()["id"]
+            response = client.post("/token", data={"username": "cacheduser", "password": "secret"})
+            user_headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            for _ in range(2):
+                response = client.get("/user/me/", headers=user_headers)
+                assert response.status_code == 200
+                assert response.json()["username"] == "cacheduser"
+            response = client.delete(f"/user/{user_id}", headers=headers)
+            assert response.status_code == 200
+            response = client.get("/user/me/", headers=user_headers)
+            assert response.status_code != 200
+
+
+class TestPermissions(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+        with TestClient(app) as client:
+            response = client.post("/user", json={"username": "buyer", "password": "secret", "roles": [{"name": ROLE_BUYER}]}, headers={
+                "Authorization": f"Bearer {cls.token}",
+            })
+            assert response.status_code == 200
+
+    def buyer_headers(self, client: TestClient) -> dict:
+        response = client.post("/token", data={"username": "buyer", "password": "secret"})
+        assert response.status_code == 200
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def test_role_mask(self):
+        with TestClient(app) as client:
+            headers = self.buyer_headers(client)
+            response = client.post("/brand", json={"name": "BuyerBrand"}, headers=headers)
+            assert response.status_code == 401
+            ENDPOINT_PERMS[ROLE_BUYER] = ["create_brand"]
+            try:
+                compile_permissions(route.endpoint.__name__ for route in app.routes)
+                response = client.post("/brand", json={"name": "BuyerBrand"}, headers=headers)
+                assert response.status_code == 200
+                response = client.delete(f"/brand/{response.json()['id']}", headers=headers)
+                assert response.status_code == 401
+            finally:
+                ENDPOINT_PERMS.pop(ROLE_BUYER)
+                compile_permissions(route.endpoint.__name__ for route in app.routes)
+
+
+class TestMetrics(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+
+    def test_metrics(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/workbuy", headers=headers)
+            assert response.status_code == 200
+            client.get("/nothing/here")
+            client.delete("/brand/999999", headers=headers)
+            response = client.get("/metrics")
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/plain")
+            text = response.text
+            assert 'http_requests_total{endpoint="list_workbuy",method="GET",status="200"}' in text
+            assert 'http_request_duration_seconds_bucket{endpoint="list_workbuy",le="+Inf"}' in text
+            assert 'http_response_size_bytes_count{endpoint="list_workbuy"}' in text
+            assert 'http_requests_in_flight{endpoint="list_workbuy"} 0' in text
+            assert 'endpoint="unmatched",method="GET",status="404"' in text
+            assert 'endpoint="delete_brand",method="DELETE",status="404"' in text
+
+    def test_query_headers(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/workbuy", headers=headers)
+            assert int(response.headers["x-db-queries"]) > 0
+            assert float(response.headers["x-db-time"]) > 0
+            response = client.get("/workbuy", headers={**headers, "Accept": "application/x-ndjson"})
+            assert response.status_code == 200
+            assert "x-db-queries" not in response.headers
+            response = client.get("/metrics")
+            assert 'db_queries_per_request_count{endpoint="list_workbuy"}' in response.text
+
+    def test_slow_query_log(self):
+        threshold = settings.slow_query_threshold
+        messages = []
+        sink = logger.add(messages.append, level="WARNING")
+        settings.slow_query_threshold = 0
+        try:
+            with TestClient(app) as client:
+                client.get("/workbuy", headers={"Authorization": f"Bearer {self.token}"})
+        finally:
+            settings.slow_query_threshold = threshold
+            logger.remove(sink)
+        assert any("Slow query in list_workbuy" in message for message in messages)
+
+
+class TestProfiling(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+
+    def test_profile(self):
+        with TestClient(app) as client:
+            response = client.get("/workbuy", headers={"Authorization": f"Bearer {self.token}"})
+            assert "x-profile-file" not in response.headers
+            response = client.get("/workbuy", headers={"Authorization": f"Bearer {self.token}", "X-Profile": "1"})
+            assert response.status_code == 200
+            path = PROFILE_DIR / response.headers["x-profile-file"]
+            assert pstats.Stats(str(path)).total_calls > 0
+            path.unlink()
+
+    def test_profile_requires_admin(self):
+        with TestClient(app) as client:
+            response = client.get("/workbuy", headers={"X-Profile": "1"})
+            assert response.status_code == 401
+            assert "x-profile-file" not in response.headers
+
+
+class TestObjectCache(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+        headers = {"Authorization": f"Bearer {cls.token}"}
+        with TestClient(app) as client:
+            customer = client.post("/customer", json={"name": "CacheCustomer"}, headers=headers).json()
+            organization = client.post("/organization", json={"name": "CacheOrganization", "prefix": "C"}, headers=headers).json()
+            taxpayer = client.post("/taxpayer", json={"name": "CacheTaxPayer", "key": "CACH010195XYZ"}, headers=headers).json()
+            response = client.post("/workbuy", json={
+                "customer_id": customer["id"],
+                "organization_id": organization["id"],
+                "works": [
+                    {
+                        "number": "C1",
+                        "taxpayer_id": taxpayer["id"],
+                        "work_unregisteredproducts": [
+                            {"description": "Desc1", "amount": 2, "price": 40},
+                        ]
+                    }
+                ]
+            }, headers=headers)
+            assert response.status_code == 200
+            cls.workbuy = response.json()
+            cls.customer_id = customer["id"]
+
+    def test_hit_and_nested_invalidation(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            work = self.workbuy["works"][0]
+            for expected in ("miss", "hit"):
+                response = client.get(f"/work/{work['id']}", headers=headers)
+                assert response.headers["x-cache"] == expected
+                response = client.get(f"/workbuy/{self.workbuy['id']}", headers=headers)
+                assert response.headers["x-cache"] == expected
+            cached = response.json()
+            line = work["work_unregisteredproducts"][0]
+            response = client.put(f"/work/{work['id']}", json={
+                "work_unregisteredproducts": [{"id": line["id"], "price": 50}]
+            }, headers=headers)
+            assert response.status_code == 200
+            response = client.get(f"/work/{work['id']}", headers=headers)
+            assert response.headers["x-cache"] == "miss"
+            assert response.json()["work_unregisteredproducts"][0]["price"] == 50
+            response = client.get(f"/workbuy/{self.workbuy['id']}", headers=headers)
+            assert response.headers["x-cache"] == "miss"
+            assert response.json()["works_total"] == cached["works_total"] + 20
+
+    def test_related_write_invalidates(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            client.get(f"/workbuy/{self.workbuy['id']}", headers=headers)
+            response = client.put(f"/customer/{self.customer_id}", json={"name": "CacheCustomer2"}, headers=headers)
+            assert response.status_code == 200
+            response = client.get(f"/workbuy/{self.workbuy['id']}", headers=headers)
+            assert response.headers["x-cache"] == "miss"
+            assert response.json()["customer"]["name"] == "CacheCustomer2"
+
+    def test_delete_invalidates(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            storagetype = client.post("/storagetype", json={"name": "CacheStorageType"}, headers=headers).json()
+            organization = client.get("/organization", headers=headers).json()[0]
+            storage = client.post("/storage", json={"organization_id": organization["id"], "storagetype_id": storagetype["id"]}, headers=headers).json()
+            for expected in ("miss", "hit"):
+                response = client.get(f"/storage/{storage['id']}", headers=headers)
+                assert response.headers["x-cache"] == expected
+            # Storage has no APIManager, so its queryset does not evict by itself
+            response = client.delete(f"/storage/{storage['id']}", headers=headers)
+            assert response.status_code == 200
+            response = client.get(f"/storage/{storage['id']}", headers=headers)
+            assert response.status_code == 404
+
+    def test_sqlite_store(self, tmp_path):
+        store = SqliteStore(str(tmp_path / "cache.sqlite3"), maxsize=2)
+        generation = store.current_generation()
+        store.set("work:1", b"1", {"Work:1", "WorkBuy:1"}, generation)
+        store.set("workbuy:1", b"2", {"WorkBuy:1"}, generation)
+        store.set("work:2", b"3", {"Work:2"}, generation)
+        assert store.get("work:1") is None
+        store.evict({"WorkBuy:1"})
+        assert store.get("workbuy:1") is None
+        assert store.get("work:2") == b"3"
+        # Stale reads started before the eviction are not stored
+        store.set("workbuy:1", b"2", {"WorkBuy:1"}, generation)
+        assert store.get("workbuy:1") is None
+
+    def test_sqlite_store_writes_off_the_loop(self, tmp_path):
+        cache = ObjectCache(SqliteStore(str(tmp_path / "cache.sqlite3"), maxsize=10))
+
+        async def write():
+            await cache.set("work", 1, b"1", {"Work:1"}, cache.generation())
+            assert cache.get("work", 1) == b"1"
+            async with cache.invalidating():
+                cache.evict({"Work:1"})
+                assert cache.get("work", 1) == b"1"
+            assert cache.get("work", 1) is None
+
+        # Not asyncio.run, it leaves no current loop for the TestClients after it
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(write())
+        finally:
+            loop.close()
+
+
+class TestReference(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+
+    def test_reference(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/reference", headers=headers)
+            assert response.status_code == 200
+            bundle = response.json()
+            assert bundle["brand"] == client.get("/brand", headers=headers).json()
+            etag = response.headers["etag"]
+            response = client.get("/reference", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.headers["etag"] == etag
+            response = client.post("/brand", json={"name": "ReferenceBrand"}, headers=headers)
+            assert response.status_code == 200
+            response = client.get("/reference", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["etag"] != etag
+            assert "ReferenceBrand" in [brand["name"] for brand in response.json()["brand"]]
+
+    def test_reference_delete(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            storagetype = client.post("/storagetype", json={"name": "ReferenceStorageType"}, headers=headers).json()
+            response = client.get("/reference", headers=headers)
+            assert storagetype in response.json()["storagetype"]
+            etag = response.headers["etag"]
+            response = client.delete(f"/storagetype/{storagetype['id']}", headers=headers)
+            assert response.status_code == 200
+            response = client.get("/reference", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert storagetype not in response.json()["storagetype"]
+
+
+class TestConditional(TestAPI):
+
+    @classmethod
+    def setup_class(cls):
+        cls.token = cls.get_token()
+
+    def test_list_not_modified(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/workbuy", headers=headers)
+            assert response.status_code == 200
+            etag = response.headers["etag"]
+            response = client.get("/workbuy", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.headers["etag"] == etag
+            # Just the rows_version aggregate
+            assert response.headers["x-db-queries"] == "1"
+            response = client.get("/workbuy?summary=true", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            # Customers are serialized inside every workbuy
+            response = client.post("/customer", json={"name": "ConditionalCustomer"}, headers=headers)
+            assert response.status_code == 200
+            response = client.get("/workbuy", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["etag"] != etag
+
+    def test_get_not_modified(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            customer = client.post("/customer", json={"name": "ConditionalCustomer2"}, headers=headers).json()
+            organization = client.post("/organization", json={"name": "ConditionalOrganization", "prefix": "E"}, headers=headers).json()
+            taxpayer = client.post("/taxpayer", json={"name": "ConditionalTaxPayer", "key": "COND010195XYZ"}, headers=headers).json()
+            workbuy = client.post("/workbuy", json={
+                "customer_id": customer["id"],
+                "organization_id": organization["id"],
+                "works": [{"number": "E1", "taxpayer_id": taxpayer["id"]}]
+            }, headers=headers).json()
+            response = client.get(f"/workbuy/{workbuy['id']}", headers=headers)
+            etag = response.headers["etag"]
+            response = client.get(f"/workbuy/{workbuy['id']}", headers={**headers, "If-None-Match": f'W/{etag}, "other"'})
+            assert response.status_code == 304
+            work = workbuy["works"][0]
+            response = client.put(f"/work/{work['id']}", json={"number": "E2"}, headers=headers)
+            assert response.status_code == 200
+            response = client.get(f"/workbuy/{workbuy['id']}", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.json()["works"][0]["number"] == "E2"
+
+    def test_outside_writes_change_etag(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = client.get("/appliance", headers=headers)
+            etag = response.headers["etag"]
+            # Written behind the app's back, like a migrator or another worker would
+            with sqlite3.connect("test.sqlite3") as connection:
+                connection.execute("INSERT INTO appliance (name) VALUES ('OutsideAppliance')")
+            response = client.get("/appliance", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert "OutsideAppliance" in [a["name"] for a in response.json()]
+
+    def test_page_etag_covers_the_page(self):
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            for name in ("EtagAppliance1", "EtagAppliance2", "EtagAppliance3"):
+                client.post("/appliance", json={"name": name}, headers=headers)
+            response = client.get("/appliance?limit=1", headers=headers)
+            etag = response.headers["etag"]
+            first_id = response.json()["items"][0]["id"]
+            with sqlite3.connect("test.sqlite3") as connection:
+                connection.execute("INSERT INTO appliance (name) VALUES ('EtagAppliance4')")
+            # Lands on a later page
+            response = client.get("/appliance?limit=1", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 304
+            with sqlite3.connect("test.sqlite3") as connection:
+                connection.execute("DELETE FROM appliance WHERE id = ?", (first_id,))
+            response = client.get("/appliance?limit=1", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.json()["items"][0]["id"] != first_id
+
+
+class TestDumpReader():
+
+    def test_read_dump(self, tmp_path, monkeypatch):
+        path = tmp_path / "dump.sql"
+        path.write_text(
+            "-- MySQL dump\n"
+            "INSERT INTO `database_product` VALUES (1,'12,34','it''s \\'q\\'',NULL,700.99,-2),(2,'a\\\\b\\n',NULL,'',1e3,0x4142);\n"
+            "INSERT INTO `django_migrations` VALUES (1,'x');\n"
+            "INSERT INTO database_product (`id`) VALUES (3);"
+        )
+        # Tokens split across reads
+        monkeypatch.setattr("main.migration.dump.CHUNK_SIZE", 3)
+        assert list(read_dump(str(path), {"database_product"})) == [
+            ("database_product", (1, "12,34", "it's 'q'", None, Decimal("700.99"), -2)),
+            ("database_product", (2, "a\\b\n", None, "", Decimal("1e3"), b"AB")),
+            ("database_product", (3,)),
+        ]
+
+
+class TestMigration():
+
+    @staticmethod
+    def run_with_db(tmp_path, func):
+        """Run ``func()`` against a fresh migration database, the next TestClient inits the app's again."""
+        async def main():
+            await Tortoise.init(
+                db_url=f"sqlite://{tmp_path / 'migration.sqlite3'}",
+                modules={"models": ["main.api.models", "main.migration.models"]}
+            )
+            try:
+                await Tortoise.generate_schemas()
+                return await func()
+            finally:
+                await Tortoise.close_connections()
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(main())
+        finally:
+            loop.close()
+
+    def test_batched_run(self):
+        pulled = []
+
+        async def items():
+            for item in range(5):
+                pulled.append(item)
+                yield item
+
+        async def write(batch):
+            # The next batch is only read once this one is written
+            assert pulled[-1] == batch[-1]
+            written.append(batch)
+
+        written = []
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(run(batched(items(), 2), write)) == 5
+        finally:
+            loop.close()
+        assert written == [[0, 1], [2, 3], [4]]
+
+    def test_checkpoint_resume(self, tmp_path):
+        path = tmp_path / "rows.csv"
+        path.write_text("n\n" + "".join(f"{n}\n" for n in range(1, 9)))
+        written = []
+
+        async def accept(row):
+            # Rejected rows still count towards the position
+            return None if int(row["n"]) % 3 == 0 else row["n"]
+
+        async def migrate(fail_at=None):
+            checkpoint = await Checkpoint("rows.csv", count_rows(str(path))).load()
+            start = checkpoint.position
+
+            async def write(batch):
+                async with in_transaction():
+                    await checkpoint.save(len(batch))
+                    if batch[0] == fail_at:
+                        raise RuntimeError("crash")
+                written.extend(batch)
+
+            rows = checkpoint.track(read_csv(str(path), checkpoint.position))
+            try:
+                await run(batched(transform(rows, accept), 2), write)
+            except RuntimeError:
+                return start, await MigrationCheckpoint.get(source="rows.csv")
+            await checkpoint.save()
+            return start, await MigrationCheckpoint.get(source="rows.csv")
+
+        async def main():
+            start, saved = await migrate(fail_at="7")
+            # The batch ending on row 5 was the last one committed
+            assert (start, saved.position, saved.written) == (0, 5, 4)
+            assert written == ["1", "2", "4", "5"]
+            start, saved = await migrate()
+            assert (start, saved.position, saved.written) == (5, 8, 6)
+            assert written == ["1", "2", "4", "5", "7", "8"]
+
+        self.run_with_db(tmp_path, main)
+
+    def test_loader_write(self, tmp_path):
+        async def main():
+            taxpayer = await TaxPayer.create(name="LoaderTaxPayer", key="LOAD010195XYZ")
+            customer = await Customer.create(name="LoaderCustomer")
+            organization = await Organization.create(name="LoaderOrganization", prefix="L")
+            workbuy = await WorkBuy.create(customer_id=customer.id, organization_id=organization.id)
+            # Rows already there, the new ids come after them
+            await Work.create(number="L0", taxpayer_id=taxpayer.id, workbuy_id=workbuy.id)
+            loader = await MigrationLoader().load()
+            new_workbuy_id = await loader.workbuy(None, datetime(2020, 1, 1), customer.id, organization.id)
+            rows = [{
+                "number": f"L{n}",
+                "taxpayer_id": taxpayer.id,
+                "workbuy_id": new_workbuy_id,
+                "work_unregisteredproducts": [{"description": f"L{n}", "amount": 1, "price": n}],
+            } for n in range(1, 4)]
+            assert await loader.write(Work, rows) == 3
+            works = await Work.filter(workbuy_id=new_workbuy_id).order_by("id").prefetch_related("work_unregisteredproducts")
+            assert [(w.number, [line.description for line in w.work_unregisteredproducts], w.total) for w in works] == [
+                ("L1", ["L1"], 1), ("L2", ["L2"], 2), ("L3", ["L3"], 3)
+            ]
+            assert (await WorkBuy.get(id=new_workbuy_id)).works_total == 6
+
+        self.run_with_db(tmp_path, main)
+
+    def test_bulk_load_chunks(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("main.migration.bulk.MAX_PARAMETERS", 5)
+
+        async def main():
+            db = Brand._meta.db
+            statements = []
+            execute_query = db.execute_query
+
+            async def counting_execute_query(query, values=None):
+                statements.append(values)
+                return await execute_query(query, values)
+
+            monkeypatch.setattr(db, "execute_query", counting_execute_query)
+            assert await bulk_load(Brand, ("id", "name"), ((n, f"Brand{n}") for n in range(10, 15))) == 5
+            # Two rows of two columns per statement fit under 5 parameters
+            assert [len(values) for values in statements] == [4, 4, 2]
+            assert await Brand.all().order_by("id").values_list("id", "name") == [(n, f"Brand{n}") for n in range(10, 15)]
+
+        self.run_with_db(tmp_path, main)
@@ -0,0 +1,22 @@
+# Fills the stored totals columns, run after totals-migration.sql on existing databases
+import asyncio
+
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+from main.api.totals import backfill_totals
+from main.settings import settings
+
+
+async def main():
+    await Tortoise.init(
+        db_url=settings.db_url,
+        modules={'models': ['main.api.models']}
+    )
+
+    async with in_transaction():
+        await backfill_totals()
+
+    await Tortoise.close_connections()
+
+asyncio.run(main())
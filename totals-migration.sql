@@ -0,0 +1,26 @@
+-- Postgres migration adding the stored totals columns (main.api.totals) and the indexes sorting
+-- and paginating on them.
+-- Run once on databases created before them, then fill the columns with totals-backfill.py.
+-- Index names are the ones Tortoise generates, so fresh schemas and migrated ones match.
+BEGIN;
+
+ALTER TABLE "order" ADD COLUMN IF NOT EXISTS "subtotal" DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE "order" ADD COLUMN IF NOT EXISTS "total" DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE "work" ADD COLUMN IF NOT EXISTS "subtotal" DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE "work" ADD COLUMN IF NOT EXISTS "total" DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE "workbuy" ADD COLUMN IF NOT EXISTS "total" DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE "workbuy" ADD COLUMN IF NOT EXISTS "works_total" DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE "workbuy" ADD COLUMN IF NOT EXISTS "earnings" DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS "idx_order_total_301ce5" ON "order" ("total");
+CREATE INDEX IF NOT EXISTS "idx_work_total_3064c2" ON "work" ("total");
+CREATE INDEX IF NOT EXISTS "idx_workbuy_total_340bda" ON "workbuy" ("total");
+CREATE INDEX IF NOT EXISTS "idx_workbuy_earning_b350c4" ON "workbuy" ("earnings");
+
+-- Keyset pagination and datetime ranges on created_at
+CREATE INDEX IF NOT EXISTS "idx_order_created_a653c8" ON "order" ("created_at");
+CREATE INDEX IF NOT EXISTS "idx_work_created_8b9590" ON "work" ("created_at");
+CREATE INDEX IF NOT EXISTS "idx_workbuy_created_744a93" ON "workbuy" ("created_at");
+CREATE INDEX IF NOT EXISTS "idx_storagebuy_created_247112" ON "storagebuy" ("created_at");
+
+COMMIT;